@@ -0,0 +1,39 @@
+import os
+import sys
+import importlib.util
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAVEGAME = os.path.join(ROOT, "savegame.space")
+
+def load_batgen():
+    # tls-batgen.py is a script with a dash in its name, so import it by path.
+    if "tls_batgen" in sys.modules:
+        return sys.modules["tls_batgen"]
+    spec = importlib.util.spec_from_file_location("tls_batgen", os.path.join(ROOT, "tls-batgen.py"))
+    module = importlib.util.module_from_spec(spec)
+    # Registered so ProcessPoolExecutor workers can find the module's functions.
+    sys.modules["tls_batgen"] = module
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope="session")
+def batgen():
+    return load_batgen()
+
+# Ship files written by battle_folder, from the savegame's "Defense Platform MK3" layer.
+SHIP_FILES = ("3.Platform.LongRangeSniper.FriendlyShip.ship", "2.Raider.CloseRangeAggressive.HostileShip.ship")
+
+@pytest.fixture
+def battle_folder(batgen, tmp_path):
+    """A folder holding a copy of savegame.space and the SHIP_FILES made from one of its layers."""
+    with open(SAVEGAME, "r") as f:
+        text = f.read()
+    with open(tmp_path / "savegame.space", "w") as f:
+        f.write(text)
+    _, nodes = batgen.parse_file(text)
+    layer = [node for node in nodes if node.tag == "Layer"][1]
+    for name in SHIP_FILES:
+        batgen.write_file(layer.attributes, layer.children, str(tmp_path / name))
+    return tmp_path
@@ -0,0 +1,180 @@
+# The parser, writer and set_attr of tls-batgen.py 1.1.5, before the
+# single-pass parser, the streaming writer and the indexed Node attribute
+# API replaced them. Kept unchanged as the reference the tests and the
+# benchmark compare the current code against.
+
+import re
+import shlex
+
+def quote_if_needed(s):
+    """
+    If the given string s contains spaces, return it surrounded by double quotes.
+    Otherwise, return it unchanged.
+    """
+    s = str(s)
+    if " " in s:
+        return f'"{s}"'
+    return s
+
+class Node:
+    def __init__(self, tag=None):
+        self.tag = tag            # The node identifier.
+        self.attributes = []      # List of (key, value) tuples.
+        self.children = []        # List of child Node objects.
+        
+    def __repr__(self):
+        return (f"Node(tag={self.tag!r}, attributes={self.attributes!r}, "
+                f"children={self.children!r})")
+        
+    def to_string(self, indent=0):
+        ind = "    " * indent
+        tag_str = quote_if_needed(self.tag) if self.tag is not None else ""
+        
+        # Prepare a horizontal candidate for attributes.
+        horiz_attrs = ""
+        if self.attributes:
+            horiz_attrs = "  ".join(f"{quote_if_needed(k)} {quote_if_needed(v)}" for k, v in self.attributes)
+        
+        if self.children:
+            horiz_header = f"{ind}BEGIN {tag_str}      {horiz_attrs}" if horiz_attrs else f"{ind}BEGIN {tag_str}"
+            use_vertical = len(horiz_header) > 220
+        else:
+            horiz_line = f"{ind}BEGIN {tag_str}      {horiz_attrs}  END" if horiz_attrs else f"{ind}BEGIN {tag_str}  END"
+            use_vertical = len(horiz_line) > 220
+        
+        lines = []
+        if self.children:
+            if not use_vertical and horiz_attrs:
+                lines.append(horiz_header)
+            else:
+                header = f"{ind}BEGIN {tag_str}" if tag_str else f"{ind}BEGIN"
+                lines.append(header)
+                for key, val in self.attributes:
+                    lines.append(f"{ind}    {quote_if_needed(key)} {quote_if_needed(val)}")
+            for child in self.children:
+                lines.append(child.to_string(indent + 1))
+            lines.append(f"{ind}END")
+            return "\n".join(lines)
+        else:
+            if not use_vertical and horiz_attrs:
+                return horiz_line
+            else:
+                header = f"{ind}BEGIN {tag_str}" if tag_str else f"{ind}BEGIN"
+                lines.append(header)
+                for key, val in self.attributes:
+                    lines.append(f"{ind}    {quote_if_needed(key)} {quote_if_needed(val)}")
+                lines.append(f"{ind}END")
+                return "\n".join(lines)
+
+def tokenize_attributes(text):
+    tokens = shlex.split(text)
+    pairs = []
+    it = iter(tokens)
+    for token in it:
+        try:
+            value = next(it)
+        except StopIteration:
+            value = ""
+        pairs.append((token, value))
+    return pairs
+
+def parse_node(lines, start_index=0):
+    i = start_index
+    line = lines[i].strip()
+    if not line.startswith("BEGIN"):
+        raise ValueError(f"Expected 'BEGIN' at line {i+1}: {line}")
+        
+    if "END" in line:
+        pattern = r'^\s*BEGIN\s+(?:"([^"]+)"|(\S+))\s*(.*?)\s*END\s*$'
+        m = re.match(pattern, line)
+        if not m:
+            raise ValueError(f"Malformed inline node at line {i+1}: {line}")
+        tag = m.group(1) if m.group(1) is not None else m.group(2)
+        attr_text = m.group(3)
+        node = Node(tag)
+        if attr_text:
+            node.attributes = tokenize_attributes(attr_text)
+        return node, i + 1
+    
+    header_str = line[len("BEGIN"):].strip()
+    tokens = shlex.split(header_str)
+    tag = tokens[0] if tokens else None
+    node = Node(tag)
+    if len(tokens) > 1:
+        attr_text = " ".join(tokens[1:])
+        node.attributes = tokenize_attributes(attr_text)
+    i += 1
+    while i < len(lines):
+        current = lines[i].strip()
+        if current.startswith("END"):
+            i += 1
+            return node, i
+        elif current.startswith("BEGIN"):
+            child, i = parse_node(lines, i)
+            node.children.append(child)
+        else:
+            if current:
+                node.attributes.extend(tokenize_attributes(current))
+            i += 1
+    raise ValueError("Missing END for node starting at line {}".format(start_index+1))
+
+def parse_file(text):
+    lines = text.splitlines()
+    header_attrs = []
+    nodes = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if i == 0 and line.strip() == "":
+            i += 1
+            continue
+        if not line.strip():
+            i += 1
+            continue
+        if not line.strip().startswith("BEGIN"):
+            header_attrs.extend(tokenize_attributes(line))
+            i += 1
+        else:
+            node, i = parse_node(lines, i)
+            nodes.append(node)
+    return header_attrs, nodes
+
+def write_header_attrs(header_attrs, file_obj):
+    if header_attrs:
+        max_key_len = max(len(key) for key, _ in header_attrs)
+        for key, val in header_attrs:
+            file_obj.write(f"{quote_if_needed(key):<{max_key_len+2}} {quote_if_needed(val)}\n")
+
+def write_file(header_attrs, nodes, filepath):
+    with open(filepath, "w") as f:
+        f.write("\n")
+        if header_attrs:
+            write_header_attrs(header_attrs, f)
+        for node in nodes:
+            f.write(node.to_string() + "\n")
+
+# Helpers for the tests.
+
+def set_attr(attributes, key, value):
+    updated = []
+    found = False
+    for k, v in attributes:
+        if k.lower() == key.lower():
+            updated.append((k, value))
+            found = True
+        else:
+            updated.append((k, v))
+    if not found:
+        updated.append((key, value))
+    return updated
+
+def as_tree(node):
+    """Return a node of either implementation as nested (tag, attributes, children) tuples."""
+    return (node.tag, [tuple(pair) for pair in node.attributes], [as_tree(child) for child in node.children])
+
+def to_legacy(node):
+    """Return a copy of a node of the current implementation as a legacy Node."""
+    legacy = Node(node.tag)
+    legacy.attributes = list(node.attributes)
+    legacy.children = [to_legacy(child) for child in node.children]
+    return legacy
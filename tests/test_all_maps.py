@@ -0,0 +1,18 @@
+import os
+import shutil
+
+import pytest
+
+def test_a_failing_map_does_not_stop_the_others(batgen, battle_folder, monkeypatch, capsys):
+    monkeypatch.chdir(battle_folder)
+    # map2 sorts first; its output path is taken by a directory, so writing it fails.
+    shutil.copy("savegame.space", "map2.space")
+    os.mkdir("map2-start.space")
+    with pytest.raises(SystemExit) as exit_info:
+        batgen.main(["--no-cache", "--all-maps"])
+    assert exit_info.value.code == 1
+    assert os.path.isfile("savegame-start.space")
+    out, err = capsys.readouterr()
+    assert "Cannot process 'map2.space'" in err
+    assert "map2.space: FAILED" in out
+    assert "1 of 2 map(s) failed" in err
@@ -0,0 +1,25 @@
+import legacy
+from conftest import SAVEGAME
+
+def test_savegame_round_trips_through_the_cache(batgen, tmp_path):
+    with open(SAVEGAME, "rb") as f:
+        data = f.read()
+    header_attrs, nodes = batgen.parse_file(data.decode())
+    cache = batgen.ParseCache(str(tmp_path))
+    cache.put(data, header_attrs, nodes)
+    cached_header, cached_nodes = cache.get(data)
+    assert [tuple(pair) for pair in cached_header] == [tuple(pair) for pair in header_attrs]
+    assert [legacy.as_tree(n) for n in cached_nodes] == [legacy.as_tree(n) for n in nodes]
+
+def test_very_deep_nesting_round_trips_through_the_cache(batgen, tmp_path, monkeypatch):
+    depth = 5000
+    monkeypatch.chdir(tmp_path)
+    with open("deep.ship", "w") as f:
+        f.write("BEGIN Node      Id 1\n" * depth + "END\n" * depth)
+    cache = batgen.ParseCache(str(tmp_path / "cache"))
+    batgen.process_file("deep.ship", cache)
+    _, (node,) = batgen.process_file("deep.ship", cache)
+    for _ in range(depth - 1):
+        (node,) = node.children
+    assert node.children == [] and node.get_attr("Id") == "1"
+    assert len(list((tmp_path / "cache").iterdir())) == 1
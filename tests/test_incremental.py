@@ -0,0 +1,73 @@
+import pytest
+
+from conftest import SHIP_FILES
+from test_jobs import run_main
+
+# SHIP_FILES[0] makes the Platform layers, SHIP_FILES[1] the Raider layers.
+EXTRA_NODE = "BEGIN Extra      Id 999999  Note added  END\n"
+
+def ship_layers(batgen, data):
+    """Return the parsed output document and its generated layers by name."""
+    doc = batgen.SaveDocument(*batgen.parse_file(data.decode()))
+    layers = {layer.get_attr("Name"): layer for layer in doc.find_all("Layer")
+              if layer.get_attr("Name").startswith(("Platform-", "Raider-"))}
+    return doc, layers
+
+def test_first_incremental_run_matches_a_normal_run(batgen, battle_folder, monkeypatch):
+    monkeypatch.chdir(battle_folder)
+    normal = run_main(batgen, ["--no-cache"])
+    assert run_main(batgen, ["--no-cache", "--incremental"]) == normal
+    # Nothing changed, so everything is reused.
+    assert run_main(batgen, ["--no-cache", "--incremental"]) == normal
+
+def test_ship_edit_keeps_other_id_ranges_and_moves_its_own(batgen, battle_folder, monkeypatch):
+    monkeypatch.chdir(battle_folder)
+    _, first = ship_layers(batgen, run_main(batgen, ["--no-cache", "--incremental"]))
+
+    # Same number of Ids: the Raider layers keep their range.
+    with open(SHIP_FILES[1], "a") as f:
+        f.write("BEGIN Extra      Note added  END\n")
+    _, same_size = ship_layers(batgen, run_main(batgen, ["--no-cache", "--incremental"]))
+    assert {name: layer.get_attr("Id") for name, layer in same_size.items()} == \
+        {name: layer.get_attr("Id") for name, layer in first.items()}
+
+    # One more Id per copy: the Raider layers move past the kept Platform range.
+    with open(SHIP_FILES[1], "a") as f:
+        f.write(EXTRA_NODE)
+    data = run_main(batgen, ["--no-cache", "--incremental"])
+    doc, layers = ship_layers(batgen, data)
+    ids = {name: int(layer.get_attr("Id")) for name, layer in layers.items()}
+    first_ids = {name: int(layer.get_attr("Id")) for name, layer in first.items()}
+    platform_ids = sorted(first_ids[name] for name in first_ids if name.startswith("Platform-"))
+    platform_end = platform_ids[-1] + platform_ids[1] - platform_ids[0]
+    raider_size = first_ids["Raider-2"] - first_ids["Raider-1"] + 1
+    for name in ids:
+        if name.startswith("Platform-"):
+            assert ids[name] == first_ids[name]
+    assert ids["Raider-1"] == platform_end
+    assert ids["Raider-2"] == platform_end + raider_size
+    assert int(doc.header.get_attr("NextId")) == platform_end + 2 * raider_size
+    for layer in layers.values():
+        assert doc.find_by_id("LayerOrders", layer.get_attr("Id")) is not None
+    assert batgen.verify_file("savegame-start.space")
+
+def test_interrupted_build_does_not_reuse_the_wrong_layers(batgen, battle_folder, monkeypatch):
+    monkeypatch.chdir(battle_folder)
+    with open(SHIP_FILES[1], "r") as f:
+        original = f.read()
+    first = run_main(batgen, ["--no-cache", "--incremental"])
+
+    # An edited ship is built, but the run stops before the manifest is saved.
+    with open(SHIP_FILES[1], "a") as f:
+        f.write(EXTRA_NODE)
+    def interrupted(self, key, entries):
+        raise KeyboardInterrupt
+    with monkeypatch.context() as m:
+        m.setattr(batgen.BuildState, "save", interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            batgen.main(["--no-cache", "--incremental"])
+
+    # Reverted, the ship matches the saved manifest again and its old layers are used.
+    with open(SHIP_FILES[1], "w") as f:
+        f.write(original)
+    assert run_main(batgen, ["--no-cache", "--incremental"]) == first
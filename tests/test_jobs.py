@@ -0,0 +1,23 @@
+from conftest import SHIP_FILES
+
+def run_main(batgen, argv):
+    batgen.main(argv)
+    with open("savegame-start.space", "rb") as f:
+        return f.read()
+
+def test_jobs_output_matches_serial_output(batgen, battle_folder, monkeypatch):
+    monkeypatch.chdir(battle_folder)
+    serial = run_main(batgen, ["--no-cache"])
+    parallel = run_main(batgen, ["--no-cache", "--jobs", "2"])
+    assert serial.count(b"BEGIN Layer") >= 5
+    assert parallel == serial
+
+def test_jobs_handles_ships_too_deep_to_pickle(batgen, battle_folder, monkeypatch):
+    monkeypatch.chdir(battle_folder)
+    depth = 800
+    with open(SHIP_FILES[0], "a") as f:
+        f.write("BEGIN Node      Id 1\n" * depth + "END\n" * depth)
+    serial = run_main(batgen, ["--no-cache"])
+    parallel = run_main(batgen, ["--no-cache", "--jobs", "2"])
+    assert serial.count(b"BEGIN Node") >= depth
+    assert parallel == serial
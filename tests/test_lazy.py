@@ -0,0 +1,19 @@
+from test_jobs import run_main
+
+def test_lazy_updates_existing_orders_like_a_full_parse(batgen, battle_folder, monkeypatch):
+    monkeypatch.chdir(battle_folder)
+    # A generated save has a SystemOrders node; add a LayerOrders for the Id
+    # the first new ship layer will get, so both are updated in place.
+    first = run_main(batgen, ["--no-cache"]).decode()
+    header_attrs, nodes = batgen.parse_file(first)
+    doc = batgen.SaveDocument(header_attrs, nodes)
+    assert doc.find("SystemOrders") is not None
+    layer_id = str(batgen.header_next_id(doc))
+    doc.append(batgen.Node("LayerOrders", [("Scope", "Layer"), ("Mining", "true"), ("Id", layer_id)]))
+    batgen.write_file(doc.header.attributes, doc.nodes, "savegame.space")
+    full = run_main(batgen, ["--no-cache"])
+    lazy = run_main(batgen, ["--no-cache", "--lazy"])
+    out = batgen.SaveDocument(*batgen.parse_file(full.decode()))
+    assert len(out.find_all("SystemOrders")) == 1
+    assert out.find_by_id("LayerOrders", layer_id).get_attr("Mining") == "false"
+    assert lazy == full
@@ -0,0 +1,38 @@
+def indexed_node(batgen, count=20):
+    node = batgen.Node("Object", [(f"Key{n}", str(n)) for n in range(count)])
+    # The first lookup scans, the second builds the index.
+    node.get_attr("Key0")
+    node.get_attr("Key1")
+    return node
+
+def test_lookups_are_case_insensitive(batgen):
+    node = indexed_node(batgen)
+    assert node.get_attr("key7") == "7"
+    assert node.has_attr("KEY19")
+    assert node.get_attr("Missing", "default") == "default"
+
+def test_remove_then_append_keeps_lookups_right(batgen):
+    node = indexed_node(batgen)
+    # Same length as before, with every position after Key3 shifted.
+    node.remove_attrs({"Key3"})
+    node.attributes.append(("New", "x"))
+    assert node.get_attr("Key5") == "5"
+    assert node.get_attr("New") == "x"
+    assert not node.has_attr("Key3")
+    node.set_attr("Key19", "changed")
+    assert node.attributes[18] == ("Key19", "changed")
+    assert node.attributes[19] == ("New", "x")
+
+def test_set_attr_appends_to_a_live_index(batgen):
+    node = indexed_node(batgen)
+    node.set_attr("Added", "1")
+    assert node.get_attr("added") == "1"
+    node.set_attr("ADDED", "2")
+    assert node.attributes[-1] == ("Added", "2")
+    assert len(node.attributes) == 21
+
+def test_remove_attrs_ignore_case(batgen):
+    node = indexed_node(batgen)
+    node.remove_attrs({"key1", "key2"}, ignore_case=True)
+    assert [k for k, _ in node.attributes[:2]] == ["Key0", "Key3"]
+    assert node.get_attr("Key4") == "4"
@@ -0,0 +1,56 @@
+import pytest
+
+import legacy
+from conftest import SAVEGAME
+
+def parse_both(batgen, text):
+    header, nodes = batgen.parse_file(text)
+    old_header, old_nodes = legacy.parse_file(text)
+    return (header, [legacy.as_tree(n) for n in nodes]), (old_header, [legacy.as_tree(n) for n in old_nodes])
+
+def test_savegame_parses_like_the_old_parser(batgen):
+    with open(SAVEGAME, "r") as f:
+        text = f.read()
+    new, old = parse_both(batgen, text)
+    assert new == old
+    assert len(new[1]) > 0
+
+@pytest.mark.parametrize("text", [
+    # Inline nodes, with and without attributes and quoted values.
+    'BEGIN Hud  Camera.x 0  Camera.y 0  END\n',
+    'BEGIN Empty  END\n',
+    'BEGIN "[i 12]"      Id 12  Name "Long Name"  Type Wall  END\n',
+    'BEGIN Room      Note "a b c"  Oxygen 4000  Entities ""  END\n',
+    # Header attributes, blank lines and vertical attributes.
+    '\nTimeIndex 12.5\nNextId 99\n\nBEGIN Layer\n    Name "Free Space"\n    Id 0\n    BEGIN Networks   END\nEND\n',
+    'BEGIN Layer      Id 3  Type NeutralShip\n    Mass 10.5\n    BEGIN Crew\n        BEGIN "[i 4]"      Id 4  Name "Jo Doe"  END\n    END\nEND\n',
+    # Odd attribute counts give the last key an empty value.
+    'BEGIN Object      Id 5  Lonely  END\n',
+])
+def test_cases_parse_like_the_old_parser(batgen, text):
+    new, old = parse_both(batgen, text)
+    assert new == old
+
+def test_deep_nesting_parses_like_the_old_parser(batgen):
+    depth = 200
+    text = "".join(f'{"    " * n}BEGIN "[i {n}]"      Id {n}\n' for n in range(depth))
+    text += "".join(f'{"    " * n}END\n' for n in reversed(range(depth)))
+    new, old = parse_both(batgen, text)
+    assert new == old
+
+def test_very_deep_nesting_does_not_recurse(batgen):
+    depth = 5000
+    text = "BEGIN Node\n" * depth + "END\n" * depth
+    _, (node,) = batgen.parse_file(text)
+    for _ in range(depth - 1):
+        (node,) = node.children
+    assert node.children == []
+
+def test_quoted_value_in_header_with_children_is_kept_whole(batgen):
+    # The old parser split this value on its space; the new one keeps it.
+    _, nodes = batgen.parse_file('BEGIN Layer      Name "Free Space"\n    BEGIN Networks   END\nEND\n')
+    assert nodes[0].get_attr("Name") == "Free Space"
+
+def test_missing_end_is_an_error(batgen):
+    with pytest.raises(ValueError, match="Missing END"):
+        batgen.parse_file("BEGIN Layer\n    Id 1\n")
@@ -0,0 +1,21 @@
+import pytest
+
+from conftest import SHIP_FILES
+
+@pytest.mark.parametrize("references", [{"include": ["Layer", "Strategy"]}, {"suffixes": ["Name", "Type", "Rotation"]}])
+def test_id_references_do_not_take_per_copy_fields(batgen, battle_folder, references):
+    rules = batgen.compile_rules({"rules": batgen.DEFAULT_RULES["rules"], "id_references": references})
+    template = batgen.compile_ship_file(str(battle_folder / SHIP_FILES[0]), rules=rules)
+    layer = template.instantiate([100], "Sniper", "FriendlyShip", "LongRangeSniper", ("1.5", "90", "-2"))
+    assert [layer.get_attr(k) for k in ("Name", "Type", "Offset.x", "Rotation", "Offset.y")] == \
+        ["Sniper", "FriendlyShip", "1.5", "90", "-2"]
+    ship_ai = [child for child in layer.children if child.tag == "ShipAI"]
+    assert ship_ai[-1].get_attr("Strategy") == "LongRangeSniper"
+    assert ship_ai[0].get_attr("Layer") == layer.get_attr("Id")
+
+@pytest.mark.parametrize("rule", [{"tag": "", "action": "drop"}, {"within": "", "action": "clear", "keys": ["Id"]},
+                                  {"action": "drop"}])
+def test_rules_matching_every_node_are_rejected(batgen, rule, capsys):
+    with pytest.raises(SystemExit):
+        batgen.compile_rules({"rules": [rule]}, "test rules")
+    assert "rule 1" in capsys.readouterr().err
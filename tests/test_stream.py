@@ -0,0 +1,21 @@
+from test_jobs import run_main
+
+def test_stream_output_matches_a_normal_run(batgen, battle_folder, monkeypatch):
+    monkeypatch.chdir(battle_folder)
+    normal = run_main(batgen, ["--no-cache"])
+    assert run_main(batgen, ["--no-cache", "--stream"]) == normal
+
+def test_stream_updates_existing_orders_like_a_normal_run(batgen, battle_folder, monkeypatch):
+    monkeypatch.chdir(battle_folder)
+    # A generated save has a SystemOrders node; add a LayerOrders for the Id
+    # the first new ship layer will get, so both are updated before streaming.
+    doc = batgen.SaveDocument(*batgen.parse_file(run_main(batgen, ["--no-cache"]).decode()))
+    layer_id = str(batgen.header_next_id(doc))
+    doc.append(batgen.Node("LayerOrders", [("Scope", "Layer"), ("Mining", "true"), ("Id", layer_id)]))
+    batgen.write_file(doc.header.attributes, doc.nodes, "savegame.space")
+    normal = run_main(batgen, ["--no-cache"])
+    out = batgen.SaveDocument(*batgen.parse_file(normal.decode()))
+    assert len(out.find_all("SystemOrders")) == 1
+    assert len([node for node in out.find_all("LayerOrders") if node.get_attr("Id") == layer_id]) == 1
+    assert run_main(batgen, ["--no-cache", "--stream"]) == normal
+    assert run_main(batgen, ["--no-cache", "--stream", "--lazy"]) == normal
@@ -0,0 +1,32 @@
+import legacy
+from conftest import SAVEGAME, SHIP_FILES
+
+def assert_writes_like_the_old_writer(batgen, tmp_path, header_attrs, nodes):
+    new_path = str(tmp_path / "new.space")
+    old_path = str(tmp_path / "old.space")
+    batgen.write_file(header_attrs, nodes, new_path)
+    legacy.write_file(header_attrs, [legacy.to_legacy(node) for node in nodes], old_path)
+    with open(new_path, "rb") as new, open(old_path, "rb") as old:
+        assert new.read() == old.read()
+
+def test_savegame_writes_like_the_old_writer(batgen, tmp_path):
+    with open(SAVEGAME, "r") as f:
+        header_attrs, nodes = batgen.parse_file(f.read())
+    assert_writes_like_the_old_writer(batgen, tmp_path, header_attrs, nodes)
+
+def test_generated_fleet_writes_like_the_old_writer(batgen, battle_folder):
+    # Ship copies share subtrees with their template, which write_file renders once.
+    doc = batgen.load_base_document(str(battle_folder / "savegame.space"))
+    fleet = [(batgen.compile_ship_file(str(battle_folder / name)), *batgen.parse_ship_filename(name)) for name in SHIP_FILES]
+    batgen.build_battle(doc, fleet)
+    assert len(doc.find_all("Layer")) >= 5
+    assert_writes_like_the_old_writer(batgen, battle_folder, doc.header.attributes, doc.nodes)
+
+def test_long_and_deep_nodes_write_like_the_old_writer(batgen, tmp_path):
+    # Lines over 220 columns switch to one attribute per line.
+    wide = batgen.Node("Wide", [(f"Key{n}", "value with spaces" if n % 3 else str(n)) for n in range(30)])
+    leaf = batgen.Node("Leaf", [("Id", "1")])
+    root = leaf
+    for n in range(300):
+        root = batgen.Node(f"Level {n}" if n % 2 else "Level", [("Id", str(n))], [root, wide] if n % 50 == 0 else [root])
+    assert_writes_like_the_old_writer(batgen, tmp_path, [("NextId", "5"), ("Long Key", "a b")], [root, wide])
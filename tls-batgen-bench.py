@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+# Benchmark suite for tls-batgen.py
+# Author: Zenrath
+
+"""
+Time the phases of tls-batgen.py on synthetic savegames and ships of
+growing size, write the results as JSON, and flag phases that got slower
+than a stored baseline.
+
+    tls-batgen-bench.py                                 # all sizes, print results
+    tls-batgen-bench.py --sizes small,medium --output results.json
+    tls-batgen-bench.py --sizes "" --file savegame.space   # a real file only
+    tls-batgen-bench.py --sizes "" --custom deep:nodes=3000,depth=12,crew=200,ships=20
+    tls-batgen-bench.py --save-baseline bench-baseline.json
+    tls-batgen-bench.py --baseline bench-baseline.json  # exit code 1 on regressions
+"""
+
+import os
+import io
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import importlib.util
+
+def load_batgen():
+    # tls-batgen.py is a script with a dash in its name, so import it by path.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tls-batgen.py")
+    spec = importlib.util.spec_from_file_location("tls_batgen", path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so ProcessPoolExecutor workers can find the module's functions.
+    sys.modules["tls_batgen"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_legacy():
+    # The 1.1.5 parser and writer the tests compare against, kept in tests/legacy.py.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "legacy.py")
+    spec = importlib.util.spec_from_file_location("legacy", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+batgen = load_batgen()
+legacy = load_legacy()
+Node = batgen.Node
+
+# Benchmark sizes. nodes, depth and attrs describe one synthetic ship: its
+# number of object nodes, how deeply they nest, and the filler attributes
+# per node. habitations, workqueues and crew are the number of nodes the
+# cleanup rules act on. layers is the number of ship layers already in the
+# base savegame, and ships the number of copies added to the battle.
+SIZES = {
+    "small":  dict(nodes=200,  depth=3, attrs=4,  habitations=1, workqueues=1,  crew=4,   layers=2,  ships=4),
+    "medium": dict(nodes=1000, depth=4, attrs=6,  habitations=2, workqueues=2,  crew=16,  layers=4,  ships=40),
+    "large":  dict(nodes=2000, depth=5, attrs=8,  habitations=4, workqueues=4,  crew=40,  layers=8,  ships=200),
+    "huge":   dict(nodes=400,  depth=6, attrs=8,  habitations=2, workqueues=2,  crew=16,  layers=16, ships=1000),
+}
+
+class ShipGenerator:
+    """
+    Build synthetic ship trees shaped like the game's: header attributes,
+    object nodes with Ids and Id references, crew members, workqueues and
+    habitation subtrees.
+    """
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.next_id = 1
+
+    def take_id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def filler(self, count):
+        return [(f"Value{k}", f"{self.random.random() * 1000:.4f}") for k in range(count)]
+
+    def objects(self, count, depth, attrs):
+        """Return count object nodes, nested up to depth levels, as a list of roots."""
+        roots = []
+        open_nodes = []  # (node, level) that may still take children.
+        ids = []
+        for _ in range(count):
+            node_id = self.take_id()
+            attributes = [("Id", str(node_id)), ("Type", self.random.choice(("Wall", "Door", "Turret", "Reactor", "Battery")))]
+            if ids:
+                attributes.append(("TargetId", str(self.random.choice(ids))))
+            attributes += self.filler(attrs)
+            node = Node("Object", attributes)
+            ids.append(node_id)
+            parents = [(n, level) for n, level in open_nodes[-depth:] if level < depth]
+            if parents and self.random.random() < 0.7:
+                parent, level = self.random.choice(parents)
+                parent.children.append(node)
+                open_nodes.append((node, level + 1))
+            else:
+                roots.append(node)
+                open_nodes.append((node, 1))
+        return roots
+
+    def crew(self, count):
+        members = []
+        for n in range(count):
+            crew_id = str(self.take_id())
+            members.append(Node(f"[i {crew_id}]", [("Id", crew_id), ("Type", "CrewMember"), ("JobId", "1"),
+                                                   ("State", "Working"), ("Name", f"Crew {n}")]))
+        return members
+
+    def workqueue(self, jobs):
+        queue = Node("WorkQueue", [("NextId", "100"), ("CargoTimer", "0.25")])
+        queue.children = [Node("Job", [("Id", str(self.take_id())), ("Type", "Build")]) for _ in range(jobs)]
+        return queue
+
+    def habitation(self, rooms):
+        habitation = Node("Habitation", [("SewageTimer", "0.5"), ("Entities", "stay")])
+        for _ in range(rooms):
+            room = Node("Room", [("Id", str(self.take_id())), ("Entities", "1 2 3")])
+            room.children.append(Node("Trade", [("Oxygen", "4000"), ("Entities", "4")]))
+            habitation.children.append(room)
+        return habitation
+
+    def ship(self, nodes, depth, attrs, habitations, workqueues, crew, name="Synthetic", faction="NeutralShip"):
+        """Return (header_attrs, top_level_nodes) of a ship file."""
+        layer_id = self.take_id()
+        header = [("TimeIndex", "12.5"), ("SaveVersion", "6"), ("Name", name), ("Id", str(layer_id)), ("SystemId", "1"),
+                  ("Type", faction), ("Offset.x", "0"), ("Offset.y", "0"), ("Rotation", "0")]
+        body = [Node("Objects", [], self.objects(nodes, depth, attrs)),
+                Node("Networks", [], [Node("Network", [("Id", "1"), ("Type", "Power")])]),
+                Node("Crew", [], self.crew(crew))]
+        body += [self.workqueue(8) for _ in range(workqueues)]
+        body += [self.habitation(4) for _ in range(habitations)]
+        return header, body
+
+    def savegame(self, layers, **ship_params):
+        """Return (header_attrs, top_level_nodes) of a savegame with layers ship layers."""
+        nodes = [Node("HUD", [("Camera.x", "0"), ("Camera.y", "0")]),
+                 Node("Missions", [("NextId", "10")], [Node("Mission", [("Id", str(n))]) for n in range(20)])]
+        for n in range(layers):
+            header, body = self.ship(name="NEWSHIP" if n == 0 else f"Layer {n}",
+                                     faction="FriendlyShip" if n == 0 else "NeutralShip", **ship_params)
+            nodes.append(Node("Layer", header, body))
+        nodes += [Node("LayerOrders", [("Id", layer.get_attr("Id")), ("Scope", "Layer")]) for layer in nodes[2:]]
+        nodes.append(Node("SystemOrders", [("Id", "1"), ("Scope", "System")]))
+        header = [("TimeIndex", "100"), ("NextId", str(self.next_id)), ("PlayTime", "100"), ("SaveVersion", "6")]
+        return header, nodes
+
+def render(header_attrs, nodes):
+    """Return the file text tls-batgen.py would write for header_attrs and nodes."""
+    out = io.StringIO()
+    out.write("\n")
+    batgen.write_header_attrs(header_attrs, out)
+    for node in nodes:
+        batgen.write_node(node, out)
+    return out.getvalue()
+
+def best_time(func, repeat, setup=None):
+    """
+    Return the best wall time of repeat calls of func, and its last result.
+    With setup, each call is func(setup()), and setup is not timed.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        gc.collect()
+        start = time.perf_counter()
+        result = func() if setup is None else func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def traced_peak(func):
+    """Return the traced peak memory of one call of func, in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+# Attributes per node in the wide attribute access phases.
+WIDE_ATTRS = 60
+
+def traced_size(func):
+    """Return the traced memory still held by the result of one call of func, in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+def all_nodes(nodes):
+    """Return nodes and all of their descendants."""
+    found = []
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        found.append(node)
+        stack.extend(node.children)
+    return found
+
+def legacy_get_attr(attributes, key):
+    # 1.1.5 had no lookup helper; its code scanned the list comparing lowercased keys.
+    for k, v in attributes:
+        if k.lower() == key.lower():
+            return v
+    return None
+
+def access_attrs(nodes):
+    """Look up and set attributes on every node the way ShipTemplate and the cleanup rules do."""
+    for node in nodes:
+        node.get_attr("Id")
+        node.get_attr("Type")
+        node.get_attr("Missing")
+        node.set_attr("Type", node.get_attr("Type", ""))
+        node.set_attr("Value0", "1.0")
+
+def access_attrs_legacy(nodes):
+    """access_attrs with the 1.1.5 scans and list-rebuilding set_attr."""
+    for node in nodes:
+        legacy_get_attr(node.attributes, "Id")
+        legacy_get_attr(node.attributes, "Type")
+        legacy_get_attr(node.attributes, "Missing")
+        node.attributes = legacy.set_attr(node.attributes, "Type", legacy_get_attr(node.attributes, "Type") or "")
+        node.attributes = legacy.set_attr(node.attributes, "Value0", "1.0")
+
+def run_tree(text, repeat):
+    """
+    Measure the memory held by the parsed tree of text, and attribute
+    access on all of its nodes, against the 1.1.5 Node and its helpers.
+    """
+    results = {"tree_bytes": traced_size(lambda: batgen.parse_file(text)),
+               "tree_legacy_bytes": traced_size(lambda: legacy.parse_file(text))}
+    nodes = all_nodes(batgen.parse_file(text)[1])
+    legacy_nodes = all_nodes(legacy.parse_file(text)[1])
+    results["tree_nodes"] = len(nodes)
+    results["attr_access"], _ = best_time(lambda: access_attrs(nodes), repeat)
+    results["attr_access_legacy"], _ = best_time(lambda: access_attrs_legacy(legacy_nodes), repeat)
+    return results
+
+def run_file(path, repeat):
+    """Run run_tree on a real .ship or .space file."""
+    with open(path, "r") as f:
+        text = f.read()
+    results = {"file_bytes": len(text)}
+    results.update(run_tree(text, repeat))
+    return results
+
+def run_size(name, params, repeat, tmpdir):
+    """Time every phase for one size and return {phase: seconds}."""
+    gen = ShipGenerator(seed=1)
+    space_params = {k: params[k] for k in ("nodes", "depth", "attrs", "habitations", "workqueues", "crew")}
+    space_text = render(*gen.savegame(params["layers"], **space_params))
+    ship_text = render(*gen.ship(**space_params))
+    results = {"space_bytes": len(space_text), "ship_bytes": len(ship_text)}
+
+    results["parse_space"], _ = best_time(lambda: batgen.parse_file(space_text), repeat)
+    results["parse_space_lazy"], _ = best_time(lambda: batgen.parse_file_lazy(space_text), repeat)
+    results["parse_ship"], ship = best_time(lambda: batgen.parse_file(ship_text), repeat)
+    # Parser throughput, in MB of input per second.
+    results["parse_space_mb_s"] = len(space_text) / 1e6 / results["parse_space"]
+    results["parse_ship_mb_s"] = len(ship_text) / 1e6 / results["parse_ship"]
+    results.update(run_tree(ship_text, repeat))
+    # The same on as many nodes with WIDE_ATTRS attributes, where lookups go through the index.
+    wide_attributes = [[("Id", str(n)), ("Type", "Wall")] + gen.filler(WIDE_ATTRS - 2) for n in range(results["tree_nodes"])]
+    wide_nodes = [Node("Object", list(attributes)) for attributes in wide_attributes]
+    legacy_wide_nodes = []
+    for attributes in wide_attributes:
+        legacy_wide_nodes.append(legacy.Node("Object"))
+        legacy_wide_nodes[-1].attributes = list(attributes)
+    results["attr_access_wide"], _ = best_time(lambda: access_attrs(wide_nodes), repeat)
+    results["attr_access_wide_legacy"], _ = best_time(lambda: access_attrs_legacy(legacy_wide_nodes), repeat)
+    # Ship cleanup rules and Id numbering run in one walk when a template is compiled.
+    results["compile_ship"], template = best_time(lambda: batgen.ShipTemplate(*ship), repeat)
+
+    def prepare():
+        doc = batgen.SaveDocument(*batgen.parse_file(space_text))
+        batgen.clear_missions(doc)
+        batgen.remove_newship_friendly(doc)
+        return doc
+    results["prepare_space"], _ = best_time(prepare, repeat)
+
+    half = max(1, params["ships"] // 2)
+    fleet = [(template, half, "Friend", "LongRangeSniper", "FriendlyShip"),
+             (template, max(1, params["ships"] - half), "Foe", "CloseRangeAggressive", "HostileShip")]
+    prepared = prepare()
+    def build(doc):
+        batgen.build_battle(doc, fleet)
+        return doc
+    # Each run builds on its own copy of the prepared document.
+    results["build_battle"], doc = best_time(build, repeat, prepared.copy)
+
+    out_path = os.path.join(tmpdir, f"{name}-start.space")
+    write = lambda: batgen.write_file(doc.header.attributes, doc.nodes, out_path)
+    results["write_file"], _ = best_time(write, repeat)
+    results["output_bytes"] = os.path.getsize(out_path)
+    # The 1.1.5 writer on the same document, for comparison. Its nodes are
+    # converted up front so only the writing is measured.
+    legacy_nodes = [legacy.to_legacy(node) for node in doc.nodes]
+    write_legacy = lambda: legacy.write_file(doc.header.attributes, legacy_nodes, out_path)
+    results["write_file_legacy"], _ = best_time(write_legacy, repeat)
+    # Traced peak memory of one more write with each, kept out of the timed runs.
+    results["write_peak_bytes"] = traced_peak(write)
+    results["write_legacy_peak_bytes"] = traced_peak(write_legacy)
+    os.remove(out_path)
+    return results
+
+def run_scaling(params, max_jobs, repeat, tmpdir):
+    """Time compile_ship_files over max_jobs distinct ship files for 1..max_jobs workers."""
+    gen = ShipGenerator(seed=2)
+    ship_params = {k: params[k] for k in ("nodes", "depth", "attrs", "habitations", "workqueues", "crew")}
+    ship_files = []
+    for n in range(max_jobs):
+        path = os.path.join(tmpdir, f"1.Ship{n}.LongRangeSniper.FriendlyShip.ship")
+        with open(path, "w") as f:
+            f.write(render(*gen.ship(**ship_params)))
+        ship_files.append(path)
+    results = {}
+    for jobs in range(1, max_jobs + 1):
+        results[f"jobs_{jobs}"], _ = best_time(lambda: batgen.compile_ship_files(ship_files, jobs), repeat)
+    return results
+
+# Keys of a size's results that are sizes in bytes rather than timings.
+BYTE_KEYS = {"space_bytes", "ship_bytes", "output_bytes", "write_peak_bytes", "write_legacy_peak_bytes",
+             "tree_bytes", "tree_legacy_bytes", "file_bytes"}
+
+# Keys of a size's results that are counts.
+COUNT_KEYS = {"tree_nodes"}
+
+# Timings of the 1.1.5 code, shown for comparison but not checked for regressions.
+LEGACY_KEYS = {"write_file_legacy", "attr_access_legacy", "attr_access_wide_legacy"}
+
+# Keys of a size's results that are throughputs; higher is better.
+RATE_KEYS = {"parse_space_mb_s", "parse_ship_mb_s"}
+
+def compare(results, baseline, threshold, min_seconds):
+    """
+    Return a list of (size, phase, baseline_seconds, seconds) for phases that
+    took more than threshold (a fraction) longer than in the baseline.
+    Phases faster than min_seconds in both runs are too noisy to judge.
+    """
+    regressions = []
+    for size, phases in results["sizes"].items():
+        base_phases = baseline.get("sizes", {}).get(size, {})
+        for phase, seconds in phases.items():
+            base = base_phases.get(phase)
+            if phase in BYTE_KEYS or phase in RATE_KEYS or phase in LEGACY_KEYS or phase in COUNT_KEYS or base is None or max(base, seconds) < min_seconds:
+                continue
+            if seconds > base * (1 + threshold):
+                regressions.append((size, phase, base, seconds))
+    return regressions
+
+def parse_size_spec(spec):
+    """
+    Parse a --custom size, NAME:KEY=VALUE,..., into (name, params). Keys
+    are those of SIZES; the ones not given are taken from the medium size.
+    Raises ValueError on a malformed spec.
+    """
+    name, sep, settings = spec.partition(":")
+    name = name.strip()
+    if not sep or not name:
+        raise ValueError("expected NAME:KEY=VALUE,...")
+    params = dict(SIZES["medium"])
+    for setting in settings.split(","):
+        if not setting.strip():
+            continue
+        key, sep, value = setting.partition("=")
+        key = key.strip()
+        if key not in params:
+            raise ValueError(f"unknown key '{key}', choose from {', '.join(params)}")
+        try:
+            params[key] = int(value)
+        except ValueError:
+            raise ValueError(f"'{key}' must be a whole number") from None
+        if params[key] < (1 if key in ("nodes", "depth", "ships") else 0):
+            raise ValueError(f"'{key}' is too small")
+    return name, params
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the parse, transform and write phases of tls-batgen.py on synthetic files.")
+    parser.add_argument("--sizes", default=",".join(SIZES), help=f"comma separated sizes to run (default: {','.join(SIZES)})")
+    parser.add_argument("--custom", action="append", default=[], metavar="NAME:KEY=VALUE,...",
+                        help=f"also run a size of your own, e.g. big:nodes=5000,depth=8,crew=100; keys are "
+                             f"{', '.join(SIZES['medium'])}, and unset ones come from the medium size (repeatable)")
+    parser.add_argument("--repeat", type=int, default=3, metavar="N", help="runs per phase; the best is kept (default: 3)")
+    parser.add_argument("--scaling", type=int, default=0, metavar="N",
+                        help="also time --jobs 1..N on N ship files of the smallest selected size")
+    parser.add_argument("--file", action="append", default=[], metavar="FILE",
+                        help="also measure the parsed tree and attribute access of a real .ship or .space file (repeatable)")
+    parser.add_argument("--output", metavar="FILE", help="write the results as JSON to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against a stored results file and exit with 1 on regressions")
+    parser.add_argument("--save-baseline", metavar="FILE", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="slowdown fraction that counts as a regression (default: 0.25)")
+    parser.add_argument("--min-seconds", type=float, default=0.005,
+                        help="ignore phases faster than this in both runs (default: 0.005)")
+    args = parser.parse_args(argv)
+    args.sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    for size in args.sizes:
+        if size not in SIZES:
+            parser.error(f"unknown size '{size}', choose from {', '.join(SIZES)}")
+    # The parameters of every size to run, in order: the chosen sizes, then the custom ones.
+    args.size_params = {size: SIZES[size] for size in args.sizes}
+    for spec in args.custom:
+        try:
+            name, params = parse_size_spec(spec)
+        except ValueError as e:
+            parser.error(f"--custom '{spec}': {e}")
+        if name in args.size_params or name in SIZES:
+            parser.error(f"--custom '{spec}': there is already a size named '{name}'")
+        args.size_params[name] = params
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if args.scaling and not args.size_params:
+        parser.error("--scaling needs at least one size")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {"version": batgen.version, "python": platform.python_version(), "platform": platform.platform(),
+               "repeat": args.repeat, "sizes": {}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size, params in args.size_params.items():
+            results["sizes"][size] = phases = run_size(size, params, args.repeat, tmpdir)
+            timings = "  ".join(f"{phase} {seconds:.4f}s" for phase, seconds in phases.items()
+                                if phase not in BYTE_KEYS and phase not in RATE_KEYS and phase not in COUNT_KEYS)
+            rates = "  ".join(f"{phase} {phases[phase]:.1f}" for phase in sorted(RATE_KEYS))
+            print(f"{size}: {timings}  |  {rates}  |  write peak {phases['write_peak_bytes'] / 1e6:.2f} MB"
+                  f" (1.1.5: {phases['write_legacy_peak_bytes'] / 1e6:.2f} MB)  |  ship tree {phases['tree_bytes'] / 1e6:.2f} MB"
+                  f" (1.1.5: {phases['tree_legacy_bytes'] / 1e6:.2f} MB)")
+        for path in args.file:
+            try:
+                results["sizes"][f"file:{os.path.basename(path)}"] = phases = run_file(path, args.repeat)
+            except (OSError, ValueError) as e:
+                sys.stderr.write(f"Error: Cannot benchmark '{path}': {e}\n")
+                sys.exit(1)
+            print(f"{os.path.basename(path)}: {phases['tree_nodes']} nodes  |  attr_access {phases['attr_access']:.4f}s"
+                  f" (1.1.5: {phases['attr_access_legacy']:.4f}s)  |  tree {phases['tree_bytes'] / 1e6:.2f} MB"
+                  f" (1.1.5: {phases['tree_legacy_bytes'] / 1e6:.2f} MB)")
+        if args.scaling:
+            smallest = min(args.size_params.values(), key=lambda params: params["nodes"])
+            results["sizes"]["scaling"] = phases = run_scaling(smallest, args.scaling, args.repeat, tmpdir)
+            print("scaling: " + "  ".join(f"{phase} {seconds:.4f}s" for phase, seconds in phases.items()))
+
+    text = json.dumps(results, indent=2)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                f.write(text + "\n")
+
+    if args.baseline:
+        try:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"Error: Cannot read baseline '{args.baseline}': {e}\n")
+            sys.exit(1)
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        for size, phase, base, seconds in regressions:
+            print(f"REGRESSION: {size} {phase}: {base:.4f}s -> {seconds:.4f}s (+{(seconds / base - 1) * 100:.0f}%)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against '{args.baseline}'.")
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,18 @@
 version = "1.1.5"
 
 import os
+import io
 import re
-import shlex
 import glob
-import copy
+import argparse
+import json
+import time
+import contextlib
+import tracemalloc
+import concurrent.futures
+import math
+import hashlib
+import marshal
 import sys
 
 def quote_if_needed(s):
@@ -22,127 +30,386 @@ def quote_if_needed(s):
         return f'"{s}"'
     return s
 
+class LowerKeys(dict):
+    """
+    The interned lowercase form of each attribute key seen. Look a key up
+    with lowers[k]; a plain subscript is the cheapest lookup in the
+    attribute scans, so unseen keys are lowered in __missing__.
+    """
+    def __missing__(self, k):
+        lower = self[k] = sys.intern(k.lower())
+        return lower
+
+_LOWER_KEYS = LowerKeys()
+
+def lower_key(k):
+    return _LOWER_KEYS[k]
+
+# Marks a node whose attributes were scanned once but not indexed.
+_SCANNED = (None, -1, None)
+
 class Node:
-    def __init__(self, tag=None):
-        self.tag = tag            # The node identifier.
-        self.attributes = []      # List of (key, value) tuples.
-        self.children = []        # List of child Node objects.
+    """
+    A BEGIN ... END node: a tag, an ordered list of (key, value) attribute
+    tuples and a list of child nodes.
+
+    Attribute lookups through get_attr/set_attr are case-insensitive. A
+    node's first lookup scans its attributes; later lookups on nodes with
+    at least INDEX_MIN_ATTRS attributes use an index of lowercase keys.
+    set_attr keeps the index up to date and remove_attrs drops it; it is
+    also rebuilt when the attribute list is replaced or changes length.
+    Edit attributes through set_attr and remove_attrs, or by replacing
+    values in place, so the index stays valid.
+    """
+    __slots__ = ("tag", "attributes", "children", "_index")
+    
+    # Nodes with fewer attributes than this are always searched linearly.
+    INDEX_MIN_ATTRS = 16
+    
+    def __init__(self, tag=None, attributes=None, children=None):
+        self.tag = tag                                                    # The node identifier.
+        self.attributes = attributes if attributes is not None else []   # List of (key, value) tuples.
+        self.children = children if children is not None else []        # List of child Node objects.
+        self._index = None
         
     def __repr__(self):
         return (f"Node(tag={self.tag!r}, attributes={self.attributes!r}, "
                 f"children={self.children!r})")
-        
-    def to_string(self, indent=0):
-        ind = "    " * indent
-        tag_str = quote_if_needed(self.tag) if self.tag is not None else ""
-        
-        # Prepare a horizontal candidate for attributes.
-        horiz_attrs = ""
-        if self.attributes:
-            horiz_attrs = "  ".join(f"{quote_if_needed(k)} {quote_if_needed(v)}" for k, v in self.attributes)
-        
-        if self.children:
-            horiz_header = f"{ind}BEGIN {tag_str}      {horiz_attrs}" if horiz_attrs else f"{ind}BEGIN {tag_str}"
-            use_vertical = len(horiz_header) > 220
-        else:
-            horiz_line = f"{ind}BEGIN {tag_str}      {horiz_attrs}  END" if horiz_attrs else f"{ind}BEGIN {tag_str}  END"
-            use_vertical = len(horiz_line) > 220
-        
-        lines = []
-        if self.children:
-            if not use_vertical and horiz_attrs:
-                lines.append(horiz_header)
+    
+    def _positions(self, key):
+        """
+        Return the positions of the attributes named key (any case), in order.
+        """
+        attributes = self.attributes
+        index = self._index
+        lower = lower_key(key)
+        if index is not None and index[0] is attributes and index[1] == len(attributes):
+            positions = index[2].get(lower, ())
+            return (positions,) if positions.__class__ is int else positions
+        lowers = _LOWER_KEYS  # lower_key(k), inlined in the loops below.
+        if index is None or len(attributes) < self.INDEX_MIN_ATTRS:
+            # A node's first lookup scans; only nodes looked up again are indexed.
+            self._index = _SCANNED
+            return [pos for pos, (k, _) in enumerate(attributes) if k == key or lowers[k] == lower]
+        # Lowercase key -> position, or a list of positions for repeated keys.
+        positions = {}
+        for pos, (k, _) in enumerate(attributes):
+            k = lowers[k]
+            found = positions.get(k)
+            if found is None:
+                positions[k] = pos
+            elif found.__class__ is int:
+                positions[k] = [found, pos]
             else:
-                header = f"{ind}BEGIN {tag_str}" if tag_str else f"{ind}BEGIN"
-                lines.append(header)
-                for key, val in self.attributes:
-                    lines.append(f"{ind}    {quote_if_needed(key)} {quote_if_needed(val)}")
-            for child in self.children:
-                lines.append(child.to_string(indent + 1))
-            lines.append(f"{ind}END")
-            return "\n".join(lines)
+                found.append(pos)
+        self._index = (attributes, len(attributes), positions)
+        found = positions.get(lower, ())
+        return (found,) if found.__class__ is int else found
+    
+    def get_attr(self, key, default=None):
+        """Return the value of the first attribute named key (any case)."""
+        attributes = self.attributes
+        index = self._index
+        if index is None or len(attributes) < self.INDEX_MIN_ATTRS:
+            # Scan, stopping at the first match.
+            if index is None:
+                self._index = _SCANNED
+            lowers = _LOWER_KEYS
+            lower = lowers[key]
+            for k, v in attributes:
+                if k == key or lowers[k] == lower:
+                    return v
+            return default
+        if index[0] is attributes and index[1] == len(attributes):
+            # _positions inlined for the common case of a valid index.
+            found = index[2].get(_LOWER_KEYS[key])
+            if found is None:
+                return default
+            return attributes[found if found.__class__ is int else found[0]][1]
+        positions = self._positions(key)
+        return attributes[positions[0]][1] if positions else default
+    
+    def has_attr(self, key):
+        return bool(self._positions(key))
+    
+    def set_attr(self, key, value):
+        """
+        Set every attribute named key (any case) to value, keeping its
+        position and spelling, or append (key, value) if there is none.
+        """
+        attributes = self.attributes
+        index = self._index
+        if index is None or len(attributes) < self.INDEX_MIN_ATTRS:
+            # Scan, as in get_attr, without building a list of positions.
+            if index is None:
+                self._index = _SCANNED
+            lowers = _LOWER_KEYS
+            lower = lowers[key]
+            found = False
+            for pos, (k, _) in enumerate(attributes):
+                if k == key or lowers[k] == lower:
+                    attributes[pos] = (k, value)
+                    found = True
+            if not found:
+                attributes.append((sys.intern(key), value))
+            return
+        positions = self._positions(key)
+        if positions:
+            for pos in positions:
+                attributes[pos] = (attributes[pos][0], value)
+        else:
+            index = self._index
+            attributes.append((sys.intern(key), value))
+            if index is not None and index[0] is attributes and index[1] == len(attributes) - 1:
+                # _positions found no key, so the new one gets its own entry.
+                index[2][lower_key(key)] = len(attributes) - 1
+                self._index = (attributes, len(attributes), index[2])
+    
+    def update_attrs(self, pairs):
+        """set_attr each (key, value) in pairs, in order."""
+        for key, value in pairs:
+            self.set_attr(key, value)
+    
+    def remove_attrs(self, keys, ignore_case=False):
+        """
+        Remove every attribute whose key is in keys, in place. With
+        ignore_case, keys must be given in lowercase.
+        """
+        attributes = self.attributes
+        if ignore_case:
+            hits = [pos for pos, (k, _) in enumerate(attributes) if lower_key(k) in keys]
         else:
-            if not use_vertical and horiz_attrs:
-                return horiz_line
+            hits = [pos for pos, (k, _) in enumerate(attributes) if k in keys]
+        for pos in reversed(hits):
+            del attributes[pos]
+        if hits:
+            # Positions after a removed attribute have moved.
+            self._index = None
+    
+    def iter_lines(self, indent=0, rendered=None, learn=True):
+        """
+        Yield the output lines (without newlines) of this node and its subtree.
+
+        A node is written on one line when that line fits in 220 columns,
+        otherwise its attributes go one per line. The tree is walked with an
+        explicit stack, so no per-subtree strings are built and deep trees do
+        not recurse.
+
+        If a dict is passed as rendered, a child subtree of this node that was
+        already met under another node (such as the sections ship copies share
+        with their template) is rendered once, kept in the dict and then
+        yielded as a single multi-line string. The dict is keyed by id(node),
+        so every node in it must outlive it. With learn false only subtrees
+        already in the dict are cached, and no new ones are added.
+        """
+        child_indent = indent + 1
+        stack = [(self, indent)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                # Closing line of a node with children, pushed below.
+                yield item
+                continue
+            node, indent = item
+            if rendered is not None and indent == child_indent and node.children:
+                key = id(node)
+                if key in rendered:
+                    text = rendered[key]
+                    if text is None:
+                        text = rendered[key] = "\n".join(node.iter_lines(indent))
+                    yield text
+                    continue
+                if learn:
+                    rendered[key] = None
+            ind = "    " * indent
+            tag_str = quote_if_needed(node.tag) if node.tag is not None else ""
+            attr_strs = [f"{k} {v}" for k, v in node.attributes]
+            
+            # Prepare a horizontal candidate for attributes.
+            horiz_attrs = "  ".join(attr_strs)
+            if attr_strs and horiz_attrs.count(" ") != 3 * len(attr_strs) - 2:
+                # Some key or value contains spaces and needs quoting.
+                attr_strs = [f"{quote_if_needed(k)} {quote_if_needed(v)}" for k, v in node.attributes]
+                horiz_attrs = "  ".join(attr_strs)
+            if node.children:
+                horiz_line = f"{ind}BEGIN {tag_str}      {horiz_attrs}" if horiz_attrs else f"{ind}BEGIN {tag_str}"
             else:
-                header = f"{ind}BEGIN {tag_str}" if tag_str else f"{ind}BEGIN"
-                lines.append(header)
-                for key, val in self.attributes:
-                    lines.append(f"{ind}    {quote_if_needed(key)} {quote_if_needed(val)}")
-                lines.append(f"{ind}END")
-                return "\n".join(lines)
+                horiz_line = f"{ind}BEGIN {tag_str}      {horiz_attrs}  END" if horiz_attrs else f"{ind}BEGIN {tag_str}  END"
+            
+            if horiz_attrs and len(horiz_line) <= 220:
+                yield horiz_line
+            else:
+                yield f"{ind}BEGIN {tag_str}" if tag_str else f"{ind}BEGIN"
+                yield from [f"{ind}    {attr_str}" for attr_str in attr_strs]
+                if not node.children:
+                    yield f"{ind}END"
+            if node.children:
+                stack.append(f"{ind}END")
+                for child in reversed(node.children):
+                    stack.append((child, indent + 1))
+    
+    def to_string(self, indent=0):
+        return "\n".join(self.iter_lines(indent))
 
-def tokenize_attributes(text):
-    tokens = shlex.split(text)
-    pairs = []
+intern = sys.intern
+
+_TOKEN_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+def split_tokens(line):
+    """
+    Split a line into whitespace separated tokens, treating a double quoted
+    run as a single token (with the quotes removed).
+    """
+    if '"' not in line:
+        return line.split()
+    return [bare or quoted for quoted, bare in _TOKEN_RE.findall(line)]
+
+def pair_tokens(tokens):
+    """
+    Pair up a flat token list into (key, value) tuples, interning the keys.
+    A trailing key without a value gets an empty string value.
+    """
+    if len(tokens) % 2:
+        tokens = tokens + [""]
     it = iter(tokens)
-    for token in it:
-        try:
-            value = next(it)
-        except StopIteration:
-            value = ""
-        pairs.append((token, value))
-    return pairs
-
-def parse_node(lines, start_index=0):
-    i = start_index
-    line = lines[i].strip()
-    if not line.startswith("BEGIN"):
-        raise ValueError(f"Expected 'BEGIN' at line {i+1}: {line}")
-        
-    if "END" in line:
-        pattern = r'^\s*BEGIN\s+(?:"([^"]+)"|(\S+))\s*(.*?)\s*END\s*$'
-        m = re.match(pattern, line)
-        if not m:
-            raise ValueError(f"Malformed inline node at line {i+1}: {line}")
-        tag = m.group(1) if m.group(1) is not None else m.group(2)
-        attr_text = m.group(3)
-        node = Node(tag)
-        if attr_text:
-            node.attributes = tokenize_attributes(attr_text)
-        return node, i + 1
-    
-    header_str = line[len("BEGIN"):].strip()
-    tokens = shlex.split(header_str)
-    tag = tokens[0] if tokens else None
-    node = Node(tag)
-    if len(tokens) > 1:
-        attr_text = " ".join(tokens[1:])
-        node.attributes = tokenize_attributes(attr_text)
-    i += 1
-    while i < len(lines):
-        current = lines[i].strip()
-        if current.startswith("END"):
-            i += 1
-            return node, i
-        elif current.startswith("BEGIN"):
-            child, i = parse_node(lines, i)
-            node.children.append(child)
-        else:
-            if current:
-                node.attributes.extend(tokenize_attributes(current))
-            i += 1
-    raise ValueError("Missing END for node starting at line {}".format(start_index+1))
+    return [(intern(k), v) for k, v in zip(it, it)]
+
+def tokenize_attributes(text):
+    return pair_tokens(split_tokens(text))
+
+def is_keyword_line(line, keyword):
+    # True if the stripped line starts with the bare token keyword.
+    n = len(keyword)
+    return line.startswith(keyword) and (len(line) == n or line[n] in " \t")
 
 def parse_file(text):
-    lines = text.splitlines()
+    """
+    Parse the text of a .space or .ship file into (header_attrs, nodes).
+
+    The text is walked once, line by line, keeping the currently open nodes
+    on an explicit stack, so deeply nested files do not run into the
+    recursion limit.
+    """
     header_attrs = []
     nodes = []
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        if i == 0 and line.strip() == "":
-            i += 1
-            continue
-        if not line.strip():
-            i += 1
+    stack = []        # Open (not yet ENDed) nodes, innermost last.
+    start_lines = []  # Line number of each open node's BEGIN, for errors.
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
             continue
-        if not line.strip().startswith("BEGIN"):
+        if is_keyword_line(line, "BEGIN"):
+            tokens = split_tokens(line)
+            # An inline node opens and closes on the same line: BEGIN tag ... END
+            inline = len(tokens) > 1 and line.endswith("END") and line[-4] in " \t"
+            body = tokens[1:-1] if inline else tokens[1:]
+            node = Node(intern(body[0]) if body else None)
+            if len(body) > 1:
+                node.attributes = pair_tokens(body[1:])
+            if stack:
+                stack[-1].children.append(node)
+            else:
+                nodes.append(node)
+            if not inline:
+                stack.append(node)
+                start_lines.append(lineno)
+        elif is_keyword_line(line, "END"):
+            if not stack:
+                raise ValueError(f"Unexpected 'END' at line {lineno}: {line}")
+            stack.pop()
+            start_lines.pop()
+        elif stack:
+            stack[-1].attributes.extend(tokenize_attributes(line))
+        else:
             header_attrs.extend(tokenize_attributes(line))
-            i += 1
+    if stack:
+        raise ValueError("Missing END for node starting at line {}".format(start_lines[-1]))
+    return header_attrs, nodes
+
+# Lines that start in column 0: header attributes and the BEGIN/END lines of top-level nodes.
+_TOP_LEVEL_LINE_RE = re.compile(r'^[^ \t\n].*', re.M)
+# The first BEGIN or END line inside a node, where its own attributes end.
+_NESTED_KEYWORD_RE = re.compile(r'^[ \t]*(?:BEGIN|END)(?:[ \t]|$)', re.M)
+
+class RawNode:
+    """
+    A top-level node kept as its source text, for savegames parsed with
+    parse_file_lazy. It is written out verbatim, and only parsed when
+    asked for: get_attr and has_attr parse just the node's own attributes
+    (those before its first child, where the game writes them), and
+    materialize returns the fully parsed Node.
+    """
+    __slots__ = ("tag", "text", "_head")
+    
+    def __init__(self, tag, text):
+        self.tag = tag
+        self.text = text
+        self._head = None
+    
+    def _head_node(self):
+        if self._head is None:
+            lines_start = self.text.find("\n") + 1
+            m = _NESTED_KEYWORD_RE.search(self.text, lines_start) if lines_start else None
+            head = self.text if m is None else self.text[:m.start()] + "END"
+            self._head = parse_file(head)[1][0]
+        return self._head
+    
+    def get_attr(self, key, default=None):
+        return self._head_node().get_attr(key, default)
+    
+    def has_attr(self, key):
+        return self._head_node().has_attr(key)
+    
+    def materialize(self):
+        """Parse the whole node into a new Node."""
+        return parse_file(self.text)[1][0]
+    
+    def iter_lines(self, indent=0, rendered=None, learn=True):
+        if indent:
+            yield from self.materialize().iter_lines(indent, rendered, learn)
         else:
-            node, i = parse_node(lines, i)
-            nodes.append(node)
+            yield self.text
+    
+    def to_string(self, indent=0):
+        return "\n".join(self.iter_lines(indent))
+
+def parse_file_lazy(text):
+    """
+    Like parse_file, but return the top-level nodes as RawNodes holding their
+    source text, found from the lines that start in column 0 (the game
+    indents everything below the top level). Only the header and these
+    lines are looked at, so the cost does not grow with the size of the
+    nodes. Text that is not laid out like that is handed to parse_file.
+    """
+    nodes = []
+    header_end = None
+    open_start = open_tag = None
+    for m in _TOP_LEVEL_LINE_RE.finditer(text):
+        line = m.group().strip()
+        if is_keyword_line(line, "BEGIN"):
+            if open_start is not None:
+                return parse_file(text)
+            if header_end is None:
+                header_end = m.start()
+            tokens = split_tokens(line)
+            inline = len(tokens) > 1 and line.endswith("END") and line[-4] in " \t"
+            body = tokens[1:-1] if inline else tokens[1:]
+            tag = intern(body[0]) if body else None
+            if inline:
+                nodes.append(RawNode(tag, text[m.start():m.end()].rstrip()))
+            else:
+                open_start, open_tag = m.start(), tag
+        elif is_keyword_line(line, "END"):
+            if open_start is None:
+                return parse_file(text)
+            nodes.append(RawNode(open_tag, text[open_start:m.end()].rstrip()))
+            open_start = None
+        elif header_end is not None:
+            # An attribute line outside any node after the first node.
+            return parse_file(text)
+    if open_start is not None:
+        return parse_file(text)
+    header_attrs, _ = parse_file(text if header_end is None else text[:header_end])
     return header_attrs, nodes
 
 def write_header_attrs(header_attrs, file_obj):
@@ -151,112 +418,405 @@ def write_header_attrs(header_attrs, file_obj):
         for key, val in header_attrs:
             file_obj.write(f"{quote_if_needed(key):<{max_key_len+2}} {quote_if_needed(val)}\n")
 
+# Lines are handed to the file object in chunks of about this many characters.
+WRITE_CHUNK_CHARS = 4 * 1024
+
+def write_node(node, file_obj, rendered=None, learn=True):
+    chunk = []
+    append = chunk.append
+    size = 0
+    limit = WRITE_CHUNK_CHARS
+    for line in node.iter_lines(rendered=rendered, learn=learn):
+        append(line)
+        size += len(line)
+        if size >= limit:
+            append("")
+            file_obj.write("\n".join(chunk))
+            chunk.clear()
+            size = 0
+    if chunk:
+        chunk.append("")
+        file_obj.write("\n".join(chunk))
+
+def forget_unshared(rendered, once):
+    """
+    Drop the children of earlier nodes that rendered still remembers as met
+    once, after a node that met new children of its own, and return the
+    children to remember as met once now. Copies of a ship are written one
+    after another, so a child only met under an earlier node is not shared.
+    """
+    met_once = {key for key, text in rendered.items() if text is None}
+    if not met_once - once:
+        return once
+    for key in once & met_once:
+        del rendered[key]
+    return met_once - once
+
 def write_file(header_attrs, nodes, filepath):
     with open(filepath, "w") as f:
         f.write("\n")
         if header_attrs:
             write_header_attrs(header_attrs, f)
+        rendered = {}
+        once = set()
         for node in nodes:
-            f.write(node.to_string() + "\n")
-
-def process_space_file(input_filepath):
-    with open(input_filepath, "r") as f:
-        file_text = f.read()
-    return parse_file(file_text)
-
-def process_ship_file(input_filepath):
-    with open(input_filepath, "r") as f:
-        file_text = f.read()
-    return parse_file(file_text)
-
-def set_attr(attributes, key, value):
-    updated = []
-    found = False
-    for k, v in attributes:
-        if k.lower() == key.lower():
-            updated.append((k, value))
-            found = True
+            write_node(node, f, rendered)
+            once = forget_unshared(rendered, once)
+
+# Bump whenever parse_file's output changes, so old cache entries are not reused.
+PARSER_VERSION = 1
+
+# Bump whenever the layout written by encode_nodes changes.
+CACHE_FORMAT = 2
+
+DEFAULT_CACHE_DIR = ".tls-batgen-cache"
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def encode_nodes(nodes):
+    """
+    Turn a list of Nodes into a flat pre-order list of (tag, attributes,
+    child count) tuples for marshal. Flat, so deep trees do not hit the
+    recursion limit here or in marshal.
+    """
+    encoded = []
+    stack = nodes[::-1]
+    while stack:
+        node = stack.pop()
+        encoded.append((node.tag, node.attributes, len(node.children)))
+        stack.extend(reversed(node.children))
+    return encoded
+
+def decode_nodes(encoded):
+    """Inverse of encode_nodes."""
+    nodes = []
+    stack = [[nodes, -1]]   # [children list, children still to come]; the top level has no count.
+    for tag, attributes, child_count in encoded:
+        node = Node(tag, attributes)
+        frame = stack[-1]
+        frame[0].append(node)
+        frame[1] -= 1
+        if child_count:
+            stack.append([node.children, child_count])
         else:
-            updated.append((k, v))
-    if not found:
-        updated.append((key, value))
-    return updated
-
-def remove_attributes(attributes, keys_to_remove):
-    return [(k, v) for (k, v) in attributes if k not in keys_to_remove]
-
-def update_related_ids(ship_node, target_old, target_new):
-    excluded = {"Id", "NextId", "NetworkId", "JobId", "CrewJobId", "LayerId"}
-    for idx, (k, v) in enumerate(ship_node.attributes):
-        if ((k.endswith("Id") and k not in excluded) or (k == "Carrying")):
-            if v == target_old:
-                ship_node.attributes[idx] = (k, target_new)
-    for child in ship_node.children:
-        update_related_ids(child, target_old, target_new)
-
-# Two-pass ID update functions:
-# assign_new_ids now skips updating the id of a node if its tag is "network".
-def assign_new_ids(node, next_id, mapping, inside_network=False):
-    if node.tag and node.tag.lower() == "network":
-        # Do not update the id attribute of a Network node.
-        for child in node.children:
-            assign_new_ids(child, next_id, mapping, inside_network=False)
-    else:
-        for idx, (k, v) in enumerate(node.attributes):
-            if k.lower() == "id":
-                old_value = v
-                new_value = str(next_id[0])
-                node.attributes[idx] = (k, new_value)
-                mapping[old_value] = new_value
-                next_id[0] += 1
-        for child in node.children:
-            assign_new_ids(child, next_id, mapping, inside_network)
-            
-def apply_related_id_mapping(node, mapping):
-    excluded = {"Id", "NextId", "NetworkId", "JobId", "CrewJobId", "LayerId"}
-    new_attrs = []
-    for k, v in node.attributes:
-        if ((k.endswith("Id") and k not in excluded) or (k == "Carrying")) and v in mapping:
-            new_attrs.append((k, mapping[v]))
+            while stack[-1][1] == 0:
+                stack.pop()
+    return nodes
+
+class ParseCache:
+    """
+    On-disk cache of parsed files, one marshal file per entry, keyed by the
+    file content, PARSER_VERSION and CACHE_FORMAT. Entries are touched on every hit, and
+    the least recently used ones are removed once the directory grows past
+    max_bytes.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+    
+    def _path(self, data):
+        digest = hashlib.sha256(b"%d.%d\0" % (PARSER_VERSION, CACHE_FORMAT) + data).hexdigest()
+        return os.path.join(self.directory, digest + ".marshal")
+    
+    def get(self, data):
+        """Return the cached (header_attrs, nodes) for this file content, or None."""
+        path = self._path(data)
+        try:
+            with open(path, "rb") as f:
+                # marshal.loads on the whole file is much faster than marshal.load(f).
+                header_attrs, encoded = marshal.loads(f.read())
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return header_attrs, decode_nodes(encoded)
+    
+    def put(self, data, header_attrs, nodes):
+        path = self._path(data)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            payload = marshal.dumps((header_attrs, encode_nodes(nodes)))
+        except (ValueError, RecursionError) as e:
+            # Left uncached, as if it were a miss every time.
+            sys.stderr.write(f"Warning: could not encode parse cache entry '{path}': {e}\n")
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+            self.evict()
+        except OSError as e:
+            # The cache is only an optimisation; carry on without it.
+            sys.stderr.write(f"Warning: could not write parse cache entry '{path}': {e}\n")
+    
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".marshal"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def process_file(input_filepath, cache=None):
+    """
+    Parse a .space or .ship file into (header_attrs, nodes), using the
+    parse cache when one is given.
+    """
+    with open(input_filepath, "rb") as f:
+        data = f.read()
+    if cache is not None:
+        cached = cache.get(data)
+        if cached is not None:
+            return cached
+    # Decoded as open(input_filepath, "r") would, so the text parsed is the text hashed.
+    header_attrs, nodes = parse_file(io.TextIOWrapper(io.BytesIO(data)).read())
+    if cache is not None:
+        cache.put(data, header_attrs, nodes)
+    return header_attrs, nodes
+
+def process_space_file(input_filepath, cache=None, lazy=False):
+    if lazy:
+        # Scanning for the top-level nodes is cheaper than loading a cached tree.
+        with open(input_filepath, "r") as f:
+            return parse_file_lazy(f.read())
+    return process_file(input_filepath, cache)
+
+def process_ship_file(input_filepath, cache=None):
+    return process_file(input_filepath, cache)
+
+class IdReferenceKeys(dict):
+    """
+    Attribute keys that hold a reference to another node's Id: keys with
+    one of the suffixes that are not excluded, and the included keys.
+    Look a key up with keys[k]; each distinct key is matched once and its
+    answer kept, so the same keys met again in every node cost one lookup.
+    """
+    def __init__(self, suffixes, exclude=(), include=()):
+        super().__init__()
+        self.suffixes = tuple(suffixes)
+        self.exclude = frozenset(exclude)
+        self.include = frozenset(include)
+    
+    def __missing__(self, k):
+        result = self[k] = (k.endswith(self.suffixes) and k not in self.exclude) or k in self.include
+        return result
+    
+    def __reduce__(self):
+        # Pickled for --jobs workers without the learned answers.
+        return (IdReferenceKeys, (self.suffixes, self.exclude, self.include))
+
+class TreeRule:
+    """
+    A cleanup rule applied to a node tree by a TreeRuleSet.
+
+    tag:         lowercase tag the rule applies to, or None for every node.
+    within:      lowercase tag of an ancestor the node must be below, or None.
+    where:       (key, value) attribute the node must have, or None.
+    drop:        remove the matching node and its subtree from its parent.
+    remove_keys: attribute keys to remove from the matching node.
+    ignore_case: match remove_keys case-insensitively.
+    action:      optional callable(node) for any other in-place edit.
+    """
+    def __init__(self, tag=None, within=None, where=None, drop=False, remove_keys=(), ignore_case=False, action=None):
+        self.tag = tag.lower() if tag else None
+        self.within = within.lower() if within else None
+        self.where = tuple(where) if where else None
+        self.drop = drop
+        self.ignore_case = ignore_case
+        self.remove_keys = frozenset(k.lower() for k in remove_keys) if ignore_case else frozenset(remove_keys)
+        self.action = action
+    
+    def __repr__(self):
+        return (f"TreeRule(tag={self.tag!r}, within={self.within!r}, where={self.where!r}, "
+                f"drop={self.drop!r}, remove_keys={sorted(self.remove_keys)!r})")
+    
+    def matches(self, node, scope):
+        if self.within is not None and self.within not in scope:
+            return False
+        return self.where is None or self.where in node.attributes
+    
+    def apply(self, node):
+        if self.remove_keys:
+            node.remove_attrs(self.remove_keys, self.ignore_case)
+        if self.action is not None:
+            self.action(node)
+
+class TreeRuleSet:
+    """
+    A set of TreeRules run together in one pre-order walk of a tree.
+
+    Rules are indexed by tag up front, so each node only checks the rules
+    that can apply to it, in the order they were given. Adding a rule does
+    not add another walk over the tree.
+    """
+    def __init__(self, rules, id_reference_keys=None, fingerprint=None):
+        self.rules = list(rules)
+        self.id_reference_keys = id_reference_keys if id_reference_keys is not None else IdReferenceKeys(("Id",))
+        # Identifies the rules in build state that depends on them.
+        self.fingerprint = fingerprint
+        tags = {rule.tag for rule in self.rules if rule.tag is not None}
+        edit_rules = [rule for rule in self.rules if not rule.drop]
+        drop_rules = [rule for rule in self.rules if rule.drop]
+        self.edit_any = [rule for rule in edit_rules if rule.tag is None]
+        self.edit_by_tag = {tag: [rule for rule in edit_rules if rule.tag in (tag, None)] for tag in tags}
+        self.drop_any = [rule for rule in drop_rules if rule.tag is None]
+        self.drop_by_tag = {tag: [rule for rule in drop_rules if rule.tag in (tag, None)] for tag in tags}
+        self.has_drop_rules = bool(drop_rules)
+        # Tags that open a scope for "within" rules.
+        self.scope_tags = frozenset(rule.within for rule in self.rules if rule.within is not None)
+    
+    def drops(self, node, scope):
+        lower = lower_key(node.tag) if node.tag else None
+        for rule in self.drop_by_tag.get(lower, self.drop_any):
+            if rule.matches(node, scope):
+                return True
+        return False
+    
+    def walk(self, root, visit=None):
+        """
+        Apply the rules to root and its subtree in a single pre-order walk.
+
+        If given, visit(node, parent, index, dropped) is called for every node
+        after the rules have edited it. index is the node's position in its
+        parent's (cleaned) children list. Subtrees removed by a drop rule are
+        still visited, unedited, with dropped=True and index -1, so a visitor
+        can account for what they contained.
+        """
+        stack = [(root, None, 0, frozenset(), False)]
+        while stack:
+            node, parent, index, scope, dropped = stack.pop()
+            lower = lower_key(node.tag) if node.tag else None
+            if not dropped:
+                for rule in self.edit_by_tag.get(lower, self.edit_any):
+                    if rule.matches(node, scope):
+                        rule.apply(node)
+            if visit is not None:
+                visit(node, parent, index, dropped)
+            children = node.children
+            if not children:
+                continue
+            if lower in self.scope_tags:
+                scope = scope | {lower}
+            if dropped:
+                stack.extend((child, node, -1, scope, True) for child in reversed(children))
+                continue
+            entries = []
+            kept = []
+            for child in children:
+                if self.has_drop_rules and self.drops(child, scope):
+                    if visit is not None:
+                        entries.append((child, node, -1, scope, True))
+                else:
+                    entries.append((child, node, len(kept), scope, False))
+                    kept.append(child)
+            if len(kept) != len(children):
+                node.children = kept
+            stack.extend(reversed(entries))
+
+# Cleanup applied to every ship layer, in the format of a --rules file.
+# A --rules file adds its rules and Id reference keys to these.
+DEFAULT_RULES = {
+    "rules": [
+        # Remove the entire workqueue node.
+        {"tag": "WorkQueue", "action": "drop"},
+        # Crew members lose their current job and state.
+        {"where": {"Type": "CrewMember"}, "action": "clear", "keys": ["JobId", "State"]},
+        # Remove all "Entities" attributes from all sub-nodes of any Habitation node.
+        {"within": "Habitation", "action": "clear", "keys": ["Entities"], "ignore_case": True},
+    ],
+    # Keys ending in "Id" are references to another node's Id, except the excluded ones.
+    "id_references": {
+        "suffixes": ["Id"],
+        "exclude": ["Id", "NextId", "NetworkId", "JobId", "CrewJobId", "LayerId"],
+        "include": ["Carrying"],
+    },
+}
+
+RULE_FIELDS = {"tag", "within", "where", "action", "keys", "ignore_case"}
+
+def compile_rules(spec, source="built-in rules"):
+    """
+    Compile rules in the --rules format into a TreeRuleSet. Each rule is
+    {"tag": ..., "within": ..., "where": {key: value}, "action": "drop" or
+    "clear", "keys": [...], "ignore_case": bool}, where tag, within and
+    where are optional filters and "clear" removes the listed keys.
+    Exits on invalid rules, naming source.
+    """
+    def fail(message):
+        sys.stderr.write(f"Error: {message} in {source}\n")
+        sys.exit(1)
+    
+    def strings(value, what):
+        if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+            fail(f"{what} must be a list of strings")
+        return value
+    
+    if not isinstance(spec, dict) or not set(spec) <= {"rules", "id_references"}:
+        fail("rules must be an object with 'rules' and 'id_references'")
+    if not isinstance(spec.get("rules", []), list):
+        fail("'rules' must be a list")
+    rules = []
+    for n, rule in enumerate(spec.get("rules", []), 1):
+        if not isinstance(rule, dict) or not set(rule) <= RULE_FIELDS:
+            fail(f"rule {n} must be an object with only the fields {', '.join(sorted(RULE_FIELDS))}")
+        for field in ("tag", "within"):
+            if field in rule and not (isinstance(rule[field], str) and rule[field]):
+                fail(f"'{field}' of rule {n} must be a tag name")
+        where = rule.get("where")
+        if where is not None and not (isinstance(where, dict) and len(where) == 1 and all(isinstance(v, str) for v in where.values())):
+            fail(f"'where' of rule {n} must be an object with one key and its value")
+        action = rule.get("action")
+        if action == "drop":
+            if "keys" in rule:
+                fail(f"rule {n} drops nodes, so it cannot have 'keys'")
+            if not (rule.get("tag") or rule.get("within") or where):
+                fail(f"rule {n} would drop every node: give it a 'tag', 'within' or 'where'")
+        elif action == "clear":
+            if not strings(rule.get("keys"), f"'keys' of rule {n}"):
+                fail(f"rule {n} clears nothing: 'keys' is empty")
         else:
-            new_attrs.append((k, v))
-    node.attributes = new_attrs
-    for child in node.children:
-        apply_related_id_mapping(child, mapping)
-
-def update_ids(node, next_id, inside_network=False):
-    mapping = {}
-    assign_new_ids(node, next_id, mapping, inside_network)
-    apply_related_id_mapping(node, mapping)
-
-def remove_workqueue(node):
-    # Remove any child whose tag is "workqueue" (case-insensitive)
-    node.children = [child for child in node.children if not (child.tag and child.tag.lower() == "workqueue")]
-    for child in node.children:
-        remove_workqueue(child)
-
-def clear_crew_attributes(node):
-    for idx in range(len(node.attributes) - 1, -1, -1):
-        k, v = node.attributes[idx]
-        if k == "Type" and v == "CrewMember":
-            node.attributes = remove_attributes(node.attributes, {"JobId", "State"})
-            break
-    for child in node.children:
-        clear_crew_attributes(child)
-
-def remove_entities_recursively(node):
-    # Remove any attribute named "Entities" (case-insensitive) from this node.
-    node.attributes = [(k, v) for k, v in node.attributes if k.lower() != "entities"]
-    for child in node.children:
-        remove_entities_recursively(child)
-
-def remove_entities_from_habitation(node):
-    # If node is a Habitation node, remove "Entities" from all its descendant nodes.
-    if node.tag and node.tag.lower() == "habitation":
-        for child in node.children:
-            remove_entities_recursively(child)
-    for child in node.children:
-        remove_entities_from_habitation(child)
+            fail(f"'action' of rule {n} must be \"drop\" or \"clear\"")
+        rules.append(TreeRule(tag=rule.get("tag"), within=rule.get("within"),
+                              where=next(iter(where.items())) if where else None, drop=action == "drop",
+                              remove_keys=rule.get("keys", ()), ignore_case=bool(rule.get("ignore_case", False))))
+    
+    references = spec.get("id_references", {})
+    if not isinstance(references, dict) or not set(references) <= {"suffixes", "exclude", "include"}:
+        fail("'id_references' must be an object with 'suffixes', 'exclude' and 'include' lists")
+    id_reference_keys = IdReferenceKeys(*(strings(references.get(field, []), f"'{field}' of 'id_references'")
+                                          for field in ("suffixes", "exclude", "include")))
+    fingerprint = hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+    return TreeRuleSet(rules, id_reference_keys, fingerprint)
+
+def load_rules(rules_filepath):
+    """Read a --rules JSON file and compile it together with DEFAULT_RULES."""
+    try:
+        with open(rules_filepath, "r") as f:
+            spec = json.load(f)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Error: Cannot read rules '{rules_filepath}': {e}\n")
+        sys.exit(1)
+    source = f"rules '{rules_filepath}'"
+    # Check the file on its own first, so errors point at its own rule numbers.
+    compile_rules(spec, source)
+    references = spec.get("id_references", {})
+    merged = {"rules": DEFAULT_RULES["rules"] + spec.get("rules", []),
+              "id_references": {field: values + references.get(field, [])
+                                for field, values in DEFAULT_RULES["id_references"].items()}}
+    return compile_rules(merged, source)
+
+SHIP_CLEANUP_RULES = compile_rules(DEFAULT_RULES)
 
 def calc_offset(n):
     if n == 0:
@@ -266,234 +826,1461 @@ def calc_offset(n):
     else:
         return -(n // 2) * 100
 
-def create_layers_for_ship(ship_filepath):
-    header, nodes = process_ship_file(ship_filepath)
+# Formations ships can be placed in (--formation). "line" is the original
+# single column per faction, 100 apart, from calc_offset.
+FORMATIONS = ("line", "grid", "wedge")
+
+# Space left between ships in grid and wedge formations, in grid cells.
+FORMATION_GAP = 20
+
+# (depth, width) used for ships without grid cells: the spacing of the line formation.
+DEFAULT_FOOTPRINT = (100, 100)
+
+def ship_footprint(layer):
+    """
+    Return the (depth, width) of a ship layer: the size along x and y of
+    the smallest box centred on the middle of its GridMap that holds every
+    occupied cell (any palette key but "."). A box around the centre
+    stays the same when the ship is turned 180 degrees, as hostile ships
+    are. Cells are one unit of Offset.x/Offset.y.
+    """
+    grid = next((child for child in layer.children if child.tag and child.tag.lower() == "gridmap"), None)
+    cells = grid and next((child for child in grid.children if child.tag and child.tag.lower() == "cells"), None)
+    if cells is None:
+        return DEFAULT_FOOTPRINT
+    try:
+        centre_x = float(grid.get_attr("Width", 0)) / 2
+        centre_y = float(grid.get_attr("Height", 0)) / 2
+    except ValueError:
+        return DEFAULT_FOOTPRINT
+    min_x = min_y = max_x = max_y = None
+    for key, value in cells.attributes:
+        if not key.startswith("row") or not key[3:].isdigit():
+            continue
+        occupied = [x for x, cell in enumerate(value.split(" ")) if cell not in (".", "")]
+        if not occupied:
+            continue
+        y = int(key[3:])
+        if min_x is None:
+            min_x, max_x, min_y, max_y = occupied[0], occupied[-1], y, y
+        else:
+            min_x, max_x = min(min_x, occupied[0]), max(max_x, occupied[-1])
+            min_y, max_y = min(min_y, y), max(max_y, y)
+    if min_x is None:
+        return DEFAULT_FOOTPRINT
+    half_x = max(centre_x - min_x, max_x + 1 - centre_x)
+    half_y = max(centre_y - min_y, max_y + 1 - centre_y)
+    return 2 * math.ceil(half_x), 2 * math.ceil(half_y)
+
+def layout_formation(footprints, formation, front_x, direction):
+    """
+    Return the (x, y) of each ship of one faction, given their (depth, width)
+    footprints in fleet order. Ships stand in ranks across y, centred on
+    y = 0; the first rank is centred on front_x and later ranks go further
+    away in direction (+1 or -1 along x). A grid has ranks of about the
+    square root of the ship count, a wedge has one ship in the first rank,
+    two in the second and so on. Boxes never overlap and are FORMATION_GAP
+    apart.
+    """
+    ranks = []
+    n = 0
+    size = math.ceil(math.sqrt(len(footprints))) if formation == "grid" else 1
+    while n < len(footprints):
+        ranks.append(footprints[n:n + size])
+        n += size
+        if formation == "wedge":
+            size += 1
+    positions = []
+    x = 0
+    last_depth = None
+    for rank in ranks:
+        depth = max(d for d, _ in rank)
+        if last_depth is not None:
+            x += last_depth // 2 + FORMATION_GAP + depth // 2
+        last_depth = depth
+        y = -((sum(w for _, w in rank) + FORMATION_GAP * (len(rank) - 1)) // 2)
+        for _, width in rank:
+            positions.append((front_x + direction * x, y + width // 2))
+            y += width + FORMATION_GAP
+    return positions
+
+# Lowercase layer attribute keys that are set per copy, and the field they take.
+LAYER_FIELDS = {"name": "name", "type": "faction", "offset.x": "offset_x", "rotation": "rotation", "offset.y": "offset_y"}
+
+ALLOWED_STRATEGIES = {"StrategyVeryCloseOrbit", "CloseRangeAggressive", "MediumRangeOrbit", "LongRangeSniper", "FastMovingJet"}
+
+SHIP_FILENAME_RE = re.compile(r'^(\d+)\.([^.]+)\.([^.]+)\.([^.]+)$')
+
+def check_ship_spec(source, copies, ship_name, strategy, faction):
+    """
+    Validate the count, name, strategy and faction of a ship, as given by
+    source (used in messages). Exits on invalid values.
+    """
+    if copies < 1:
+        sys.stderr.write(f"Error: <count> in {source} must be an integer ≥ 1\n")
+        sys.exit(1)
+    if not re.match(r'^[A-Za-z0-9 \-]+$', ship_name):
+        sys.stderr.write(f"Error: <ship-name> in {source} contains invalid characters. Allowed: alphanumeric, space, and '-'\n")
+        sys.exit(1)
+    if faction not in {"FriendlyShip", "HostileShip"}:
+        sys.stderr.write(f"Error: <faction> in {source} must be 'FriendlyShip' or 'HostileShip'\n")
+        sys.exit(1)
+    if strategy not in ALLOWED_STRATEGIES:
+        sys.stderr.write(f"Warning: <strategy> in {source} is '{strategy}', which is not one of the allowed values: {', '.join(ALLOWED_STRATEGIES)}\n")
+        # Continue despite the warning.
+
+def parse_ship_filename(ship_filepath):
+    """
+    Validate a ship filename of the form <count>.<ship-name>.<strategy>.<faction>.ship
+    and return (copies, ship_name, strategy, faction). Exits on invalid names.
+    """
     base = os.path.splitext(os.path.basename(ship_filepath))[0]
-    m = re.match(r'^(\d+)\.([^.]+)\.([^.]+)\.([^.]+)$', base)
+    m = SHIP_FILENAME_RE.match(base)
     if not m:
         sys.stderr.write(f"Error: Filename '{os.path.basename(ship_filepath)}' does not conform to expected format: <count>.<ship-name>.<strategy>.<faction>.ship\n")
         sys.exit(1)
     copies, ship_name, strategy, faction = m.groups()
     try:
         copies_int = int(copies)
-        if copies_int < 1:
-            sys.stderr.write(f"Error: <count> in filename '{os.path.basename(ship_filepath)}' must be an integer ≥ 1\n")
-            sys.exit(1)
     except ValueError:
         sys.stderr.write(f"Error: <count> in filename '{os.path.basename(ship_filepath)}' must be an integer\n")
         sys.exit(1)
-    if not re.match(r'^[A-Za-z0-9 \-]+$', ship_name):
-        sys.stderr.write(f"Error: <ship-name> in filename '{os.path.basename(ship_filepath)}' contains invalid characters. Allowed: alphanumeric, space, and '-'\n")
-        sys.exit(1)
-    if faction not in {"FriendlyShip", "HostileShip"}:
-        sys.stderr.write(f"Error: <faction> in filename '{os.path.basename(ship_filepath)}' must be 'FriendlyShip' or 'HostileShip'\n")
-        sys.exit(1)
-    allowed_strategies = {"StrategyVeryCloseOrbit", "CloseRangeAggressive", "MediumRangeOrbit", "LongRangeSniper", "FastMovingJet"}
-    if strategy not in allowed_strategies:
-        sys.stderr.write(f"Warning: <strategy> in filename '{os.path.basename(ship_filepath)}' is '{strategy}', which is not one of the allowed values: {', '.join(allowed_strategies)}\n")
-        # Continue despite the warning.
-    
-    layer = Node("Layer")
-    layer.attributes.extend(header)
-    layer.attributes = set_attr(layer.attributes, "Name", ship_name)
-    layer.attributes = set_attr(layer.attributes, "Type", faction)
-    layer.attributes = remove_attributes(layer.attributes, {"TimeIndex", "SaveVersion"})
-    for node in nodes:
-        layer.children.append(node)
-    
-    # Add a ShipAI sub-node with Strategy set to <strategy>, Engaged set to "true",
-    # Broadside set to "-1"
-    ship_ai = Node("ShipAI")
-    ship_ai.attributes = set_attr([], "Strategy", strategy)
-    ship_ai.attributes = set_attr(ship_ai.attributes, "Engaged", "true")
-    ship_ai.attributes = set_attr(ship_ai.attributes, "Broadside", "-1")
-    layer.children.append(ship_ai)
-    
-    layers = []
-    for i in range(1, copies_int + 1):
-        new_layer = copy.deepcopy(layer)
-        if copies_int > 1:
-            base_name = ""
-            for k, v in new_layer.attributes:
-                if k.lower() == "name":
-                    base_name = v
+    check_ship_spec(f"filename '{os.path.basename(ship_filepath)}'", copies_int, ship_name, strategy, faction)
+    return copies_int, ship_name, strategy, faction
+
+class ShipTemplate:
+    """
+    A ship layer compiled once from a parsed .ship file.
+
+    Compiling builds the layer (header attributes, ship nodes and a ShipAI
+    sub-node), then a single walk applies the cleanup rules, works out the
+    two-pass ID remap and records every attribute that differs between
+    copies: the ID slots, the ID references, the name/faction/strategy and
+    the position. instantiate() then produces a copy by patching only those
+    slots. Subtrees without any slot are shared between copies, so layers
+    returned by instantiate() must not be modified below the layer node.
+    """
+    def __init__(self, header, nodes, rules=SHIP_CLEANUP_RULES):
+        layer = Node("Layer", list(header), list(nodes))
+        # Name and Type are patched per copy, set them now so they keep their position.
+        layer.set_attr("Name", "")
+        layer.set_attr("Type", "")
+        layer.remove_attrs({"TimeIndex", "SaveVersion"})
+        self.footprint = ship_footprint(layer)
+        
+        # Add a ShipAI sub-node with Strategy set to <strategy>, Engaged set to "true",
+        # Broadside set to "-1"
+        ship_ai = Node("ShipAI", [("Strategy", ""), ("Engaged", "true"), ("Broadside", "-1")])
+        layer.children.append(ship_ai)
+        
+        # Position attributes are set per copy, in the same order as always.
+        layer.set_attr("Offset.x", "")
+        layer.set_attr("Rotation", "")
+        layer.set_attr("Offset.y", "")
+        # The layer is numbered first, so its first Id becomes the layer Id;
+        # the first ShipAI sub-node points at it through its Layer attribute.
+        layer_slot = 0 if layer.has_attr("Id") else None
+        layer_ship_ai = None
+        if layer_slot is not None:
+            for child in layer.children:
+                if child.tag and child.tag.lower() == "shipai":
+                    child.set_attr("Layer", "")
+                    layer_ship_ai = child
                     break
-            new_name = f"{base_name}-{i}"
-            new_layer.attributes = set_attr(new_layer.attributes, "Name", new_name)
-        new_layer.attributes = remove_attributes(new_layer.attributes, {"TimeIndex", "SaveVersion"})
-        layers.append(new_layer)
-    return layers
-
-def remove_newship_friendly(nodes):
-    new_nodes = []
-    for node in nodes:
-        node.children = remove_newship_friendly(node.children)
-        name_val = None
-        type_val = None
-        for k, v in node.attributes:
-            if k.lower() == "name":
-                name_val = v
-            if k.lower() == "type":
-                type_val = v
-        if not (name_val == "NEWSHIP" and type_val == "FriendlyShip"):
-            new_nodes.append(node)
-    return new_nodes
-
-def update_shipai_layer_attribute(layer):
-    layer_id = None
-    for k, v in layer.attributes:
-        if k.lower() == "id":
-            layer_id = v
-            break
-    if layer_id is not None:
-        for child in layer.children:
-            if child.tag and child.tag.lower() == "shipai":
-                child.attributes = set_attr(child.attributes, "Layer", layer_id)
-                break
+        self.layer_slot = layer_slot
+        
+        # One walk applies the cleanup rules, numbers every Id in pre-order
+        # (skipping the Id of Network nodes) and records the slots of the nodes
+        # that survive the cleanup. Ids inside removed subtrees still use up a
+        # number, so the numbering matches a remap of the uncleaned layer.
+        # A slot is (attribute index, field, number): field None means the
+        # value is the copy's first Id + number, otherwise it names a per-copy
+        # value.
+        order = []          # Pre-order (node, parent position, child index).
+        positions = {}      # id(node) -> position in order.
+        patches = {}        # Position in order -> list of slots.
+        references = []     # (position, attribute index, referenced old Id).
+        mapping = {}        # old Id value -> number.
+        id_count = 0
+        id_reference_keys = rules.id_reference_keys
+        
+        def visit(node, parent, index, dropped):
+            nonlocal id_count
+            is_network = node.tag and lower_key(node.tag) == "network"
+            if dropped:
+                if not is_network:
+                    for k, v in node.attributes:
+                        if lower_key(k) == "id":
+                            mapping[v] = id_count
+                            id_count += 1
+                return
+            pos = len(order)
+            order.append((node, positions[id(parent)] if parent is not None else -1, index))
+            positions[id(node)] = pos
+            slots = []
+            for idx, (k, v) in enumerate(node.attributes):
+                lower = lower_key(k)
+                if lower == "id" and not is_network:
+                    mapping[v] = id_count
+                    slots.append((idx, None, id_count))
+                    id_count += 1
+                # Per-copy values win over id_references, which a --rules
+                # file may extend to the same keys.
+                elif node is layer and lower in LAYER_FIELDS:
+                    slots.append((idx, LAYER_FIELDS[lower], 0))
+                elif node is ship_ai and lower == "strategy":
+                    slots.append((idx, "strategy", 0))
+                elif node is layer_ship_ai and lower == "layer":
+                    slots.append((idx, None, layer_slot))
+                elif id_reference_keys[k]:
+                    references.append((pos, idx, v))
+            if slots:
+                patches[pos] = slots
+        
+        rules.walk(layer, visit)
+        self.id_count = id_count
+        # References can point forward, so they are resolved once every Id is numbered.
+        for pos, idx, v in references:
+            if v in mapping:
+                patches.setdefault(pos, []).append((idx, None, mapping[v]))
+        
+        # Every patched node and all of its ancestors are copied per instance;
+        # the plan lists them parents first.
+        needed = set()
+        for pos in patches:
+            while pos >= 0 and pos not in needed:
+                needed.add(pos)
+                pos = order[pos][1]
+        self.plan = []
+        plan_index = {}
+        for pos in sorted(needed):
+            node, parent_pos, child_index = order[pos]
+            plan_index[pos] = len(self.plan)
+            self.plan.append([node, patches.get(pos, ()), plan_index.get(parent_pos, -1), child_index, False])
+            if parent_pos >= 0:
+                # The parent needs its own children list to swap this copy in.
+                self.plan[plan_index[parent_pos]][4] = True
+    
+    def shared_children(self):
+        """Return the children of the layer that every copy shares with the template."""
+        layer = self.plan[0][0]
+        copied = {child_index for _, _, parent_index, child_index, _ in self.plan if parent_index == 0}
+        return [child for index, child in enumerate(layer.children) if index not in copied]
+    
+    def instantiate(self, next_id, name, faction, strategy, position):
+        """
+        Return a new layer for this ship, with Ids allocated from next_id (a
+        one-element list that is advanced by id_count). position is the
+        (Offset.x, Rotation, Offset.y) triple as strings.
+        """
+        base = next_id[0]
+        next_id[0] += self.id_count
+        fields = {"name": name, "faction": faction, "strategy": strategy,
+                  "offset_x": position[0], "rotation": position[1], "offset_y": position[2]}
+        copies = []
+        for node, slots, parent_index, child_index, copy_children in self.plan:
+            if slots:
+                attributes = list(node.attributes)
+                for idx, field, number in slots:
+                    attributes[idx] = (attributes[idx][0], str(base + number) if field is None else fields[field])
+            else:
+                attributes = node.attributes
+            new = Node(node.tag, attributes, list(node.children) if copy_children else node.children)
+            if parent_index >= 0:
+                copies[parent_index].children[child_index] = new
+            copies.append(new)
+        return copies[0]
 
-def main():
-    # Print startup header.
-    print(f"TLS v: PC - ALPHA13D - STEAM, Script v: {version} by Zenrath")
+def compile_ship_file(ship_filepath, cache=None, rules=SHIP_CLEANUP_RULES):
+    """Parse a ship file and compile it into a ShipTemplate."""
+    return ShipTemplate(*process_ship_file(ship_filepath, cache), rules)
+
+def compile_ship_files(ship_files, jobs=1, cache=None, rules=SHIP_CLEANUP_RULES):
+    """
+    Return a ShipTemplate for each ship file, in order. With jobs > 1 the
+    files are parsed and compiled in a pool of that many processes.
+    Templates take their Ids from the caller at instantiate() time, so the
+    result does not depend on which worker compiled which file.
+    """
+    if jobs <= 1 or len(ship_files) < 2:
+        return [compile_ship_file(f, cache, rules) for f in ship_files]
+    templates = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(ship_files))) as pool:
+        futures = [pool.submit(compile_ship_file, f, cache, rules) for f in ship_files]
+        for ship_file, future in zip(ship_files, futures):
+            try:
+                templates.append(future.result())
+            except RecursionError:
+                # Pickling recurses through the node tree, so a template nested
+                # too deeply cannot be sent back; compile it here instead.
+                templates.append(compile_ship_file(ship_file, cache, rules))
+    return templates
+
+class SaveDocument:
+    """
+    A parsed savegame: the header (a tag-less Node holding the header
+    attributes) and the top-level nodes in order.
+
+    Top-level nodes are indexed by lowercase tag and by (lowercase tag, Id),
+    so lookups do not scan the whole document. Add and remove top-level
+    nodes through append() and remove() to keep the indexes up to date, and
+    call reindex() after changing the Id of a top-level node.
+    """
+    def __init__(self, header_attrs, nodes):
+        self.header = Node(None, header_attrs)
+        self.nodes = []
+        self._by_tag = {}   # Lowercase tag -> nodes in document order.
+        self._by_id = {}    # (lowercase tag, Id) -> first node in document order.
+        self._ids = {}      # id(node) -> the Id it is indexed under.
+        for node in nodes:
+            self.append(node)
     
-    # Locate .space file, ignoring those ending with "-start" or "-end".
-    space_files = glob.glob("*.space")
-    space_files = [f for f in space_files if not (f.endswith("-start.space") or f.endswith("-end.space"))]
-    if not space_files:
-        sys.stderr.write("Error: No valid savegame .space file found.\n")
-        sys.exit(1)
-    main_space_file = space_files[0]
-    main_header, main_nodes = process_space_file(main_space_file)
+    def append(self, node):
+        self.nodes.append(node)
+        tag = node.tag.lower() if node.tag else None
+        self._by_tag.setdefault(tag, []).append(node)
+        self._index_id(node, tag)
+    
+    def remove(self, node):
+        self.nodes.remove(node)
+        tag = node.tag.lower() if node.tag else None
+        self._by_tag[tag].remove(node)
+        self._unindex_id(node, tag)
+    
+    def replace(self, old, new):
+        """Put new in the place of the top-level node old."""
+        self.nodes[self.nodes.index(old)] = new
+        tag = old.tag.lower() if old.tag else None
+        same_tag = self._by_tag[tag]
+        node_id = new.get_attr("Id")
+        if node_id == self._ids[id(old)]:
+            # Same Id: new takes the place of old in the Id index as well.
+            del self._ids[id(old)]
+            self._ids[id(new)] = node_id
+            if node_id is not None and self._by_id.get((tag, node_id)) is old:
+                self._by_id[(tag, node_id)] = new
+            same_tag[same_tag.index(old)] = new
+        else:
+            # Unindexed while old is still listed, as _unindex_id looks up
+            # the Ids of the other nodes with this tag.
+            self._unindex_id(old, tag)
+            same_tag[same_tag.index(old)] = new
+            self._index_id(new, tag)
+    
+    def edit(self, node):
+        """
+        Return node ready to be changed in place: a RawNode is parsed and
+        replaced by the resulting Node first.
+        """
+        if isinstance(node, RawNode):
+            parsed = node.materialize()
+            self.replace(node, parsed)
+            return parsed
+        return node
+    
+    def reindex(self, node):
+        tag = node.tag.lower() if node.tag else None
+        self._unindex_id(node, tag)
+        self._index_id(node, tag)
+    
+    def _index_id(self, node, tag):
+        node_id = node.get_attr("Id")
+        self._ids[id(node)] = node_id
+        if node_id is not None:
+            self._by_id.setdefault((tag, node_id), node)
+    
+    def _unindex_id(self, node, tag):
+        key = (tag, self._ids.pop(id(node)))
+        if self._by_id.get(key) is node:
+            del self._by_id[key]
+            # Another node with the same tag and Id takes its place.
+            for other in self._by_tag.get(tag, ()):
+                if other is not node and self._ids[id(other)] == key[1]:
+                    self._by_id[key] = other
+                    break
+    
+    def copy(self):
+        """
+        Return a copy that can be changed without touching this document.
+        The header and top-level nodes are copied; their subtrees are shared,
+        so only top-level attributes of the copy may be changed in place.
+        RawNodes are never changed in place and are shared as they are.
+        """
+        return SaveDocument(list(self.header.attributes),
+                            [node if isinstance(node, RawNode) else Node(node.tag, list(node.attributes), node.children)
+                             for node in self.nodes])
     
+    def find_all(self, tag):
+        """Return the top-level nodes with this tag (any case), in order."""
+        return list(self._by_tag.get(tag.lower(), ()))
+    
+    def find(self, tag):
+        """Return the first top-level node with this tag (any case), or None."""
+        nodes = self._by_tag.get(tag.lower())
+        return nodes[0] if nodes else None
+    
+    def find_by_id(self, tag, node_id):
+        """Return the first top-level node with this tag and Id, or None."""
+        return self._by_id.get((tag.lower(), node_id))
+
+def clear_missions(doc):
     # Remove all content from the top-level "Missions" node (if it exists)
-    for node in main_nodes:
-        if node.tag and node.tag.lower() == "missions":
-            node.attributes = []
-            node.children = []
+    for node in doc.find_all("Missions"):
+        doc.replace(node, Node(node.tag))
+
+def remove_newship_friendly(doc):
+    # Friendly newships are top-level layers named NEWSHIP.
+    for node in doc.find_all("Layer"):
+        if node.get_attr("Name") == "NEWSHIP" and node.get_attr("Type") == "FriendlyShip":
+            doc.remove(node)
+
+# Attributes of the top-level LayerOrders node of each appended ship, before its Id.
+LAYER_ORDERS_ATTRS = [("Scope", "Layer"), ("Salvage", "false"), ("Gather", "false"), ("Mining", "false"), ("ExteriorWork", "false")]
+
+# Attributes of the top-level SystemOrders node.
+SYSTEM_ORDERS_ATTRS = [("Id", "1"), ("Scope", "System"), ("FleetLogistics", "false"), ("BattleStations", "true")]
+
+def upsert_layer_orders(doc, layer_id):
+    # Create or update the top-level "LayerOrders" node of a layer.
+    node = doc.find_by_id("LayerOrders", layer_id)
+    if node is not None:
+        node = doc.edit(node)
+        node.update_attrs(LAYER_ORDERS_ATTRS)
+        node.set_attr("Id", layer_id)
+    else:
+        doc.append(Node("LayerOrders", LAYER_ORDERS_ATTRS + [("Id", layer_id)]))
+
+def upsert_system_orders(doc):
+    # Create or update the top-level "SystemOrders" node.
+    node = doc.find("SystemOrders")
+    if node is not None:
+        node = doc.edit(node)
+        node.update_attrs(SYSTEM_ORDERS_ATTRS)
+        doc.reindex(node)
+    else:
+        doc.append(Node("SystemOrders", list(SYSTEM_ORDERS_ATTRS)))
+
+def count_tree(nodes):
+    """Return (node_count, attribute_count) of nodes and their subtrees; a RawNode counts as one node."""
+    node_count = attr_count = 0
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        node_count += 1
+        if not isinstance(node, RawNode):
+            attr_count += len(node.attributes)
+            stack.extend(node.children)
+    return node_count, attr_count
+
+class Profiler:
+    """
+    Wall time, peak traced memory and counters of the phases of a run, for
+    --profile. Time a phase with `with profiler.phase(name):`; count() adds
+    to a counter of the phase being timed. Memory is traced with
+    tracemalloc, which slows the run down, so the times are best compared
+    with each other rather than with an unprofiled run. Phases may nest; an
+    outer phase's peak includes those of the phases inside it.
+    """
+    def __init__(self):
+        self.phases = []
+        self._current = None
+        self._peak = 0
+        tracemalloc.start()
+        self._start = time.perf_counter()
     
-    # Remove existing friendly newship nodes only once from the source .space file.
-    main_nodes = remove_newship_friendly(main_nodes)
+    @contextlib.contextmanager
+    def phase(self, name):
+        record = {"name": name, "seconds": 0.0, "peak_bytes": 0, "counts": {}}
+        outer, self._current = self._current, record
+        # reset_peak() forgets the peak so far, which belongs to the enclosing phase.
+        peak_before = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            # Nested phases have raised record["peak_bytes"] to their own peaks.
+            record["peak_bytes"] = max(record["peak_bytes"], tracemalloc.get_traced_memory()[1])
+            self.phases.append(record)
+            self._current = outer
+            if outer is not None:
+                outer["peak_bytes"] = max(outer["peak_bytes"], peak_before, record["peak_bytes"])
+            self._peak = max(self._peak, peak_before, record["peak_bytes"])
     
-    next_id_value = 1
-    for k, v in main_header:
-        if k.lower() == "nextid":
-            try:
-                next_id_value = int(v)
-            except ValueError:
-                next_id_value = 1
-            break
-    next_id = [next_id_value]
+    def count(self, key, n=1):
+        if self._current is not None:
+            counts = self._current["counts"]
+            counts[key] = counts.get(key, 0) + n
     
-    # Initialize independent counters for Offset.y.
-    friendly_count = 0
-    hostile_count = 0
+    def count_tree(self, nodes):
+        node_count, attr_count = count_tree(nodes)
+        self.count("nodes", node_count)
+        self.count("attributes", attr_count)
     
-    # Dictionary to record ship file summary.
-    ship_summary = {}
+    def report(self):
+        totals = {}
+        for record in self.phases:
+            for key, n in record["counts"].items():
+                totals[key] = totals.get(key, 0) + n
+        return {"version": version, "total_seconds": time.perf_counter() - self._start,
+                "peak_bytes": max(self._peak, tracemalloc.get_traced_memory()[1]) if tracemalloc.is_tracing() else None,
+                "totals": totals, "phases": self.phases}
     
-    ship_files = glob.glob("*.ship")
-    if not ship_files:
-        sys.stderr.write("Error: No .ship files found in the folder.\n")
-        sys.exit(1)
+    def print_summary(self):
+        width = max([len(record["name"]) for record in self.phases] + [5])
+        print(f"\nProfile (times include tracemalloc overhead):")
+        print(f"    {'Phase':<{width}}  {'Time':>9}  {'Peak MB':>8}  Counts")
+        for record in self.phases:
+            counts = "  ".join(f"{key} {n}" for key, n in record["counts"].items())
+            print(f"    {record['name']:<{width}}  {record['seconds']:>8.3f}s  {record['peak_bytes'] / 1e6:>8.1f}  {counts}")
+        report = self.report()
+        print(f"    {'Total':<{width}}  {report['total_seconds']:>8.3f}s")
+    
+    def stop(self, json_filepath=None):
+        if json_filepath:
+            with open(json_filepath, "w") as f:
+                json.dump(self.report(), f, indent=2)
+                f.write("\n")
+        tracemalloc.stop()
+
+class NullProfiler:
+    """Stand-in for Profiler when --profile is off; does nothing."""
+    _phase = contextlib.nullcontext()
+    
+    def phase(self, name):
+        return self._phase
+    
+    def count(self, key, n=1):
+        pass
+    
+    def count_tree(self, nodes):
+        pass
+
+NO_PROFILER = NullProfiler()
+
+def load_base_document(space_filepath, cache=None, lazy=False, profiler=NO_PROFILER):
+    """
+    Parse a savegame and strip what every generated battle removes from it.
+    With lazy, top-level nodes are kept as RawNodes until they are edited.
+    """
+    with profiler.phase(f"parse {os.path.basename(space_filepath)}"):
+        header_attrs, nodes = process_space_file(space_filepath, cache, lazy)
+        profiler.count_tree(nodes)
+    with profiler.phase("prepare savegame"):
+        doc = SaveDocument(header_attrs, nodes)
+        clear_missions(doc)
+        # Remove existing friendly newship nodes only once from the source .space file.
+        remove_newship_friendly(doc)
+    return doc
+
+def load_ship_templates(ship_files, jobs=1, cache=None, profiler=NO_PROFILER, rules=SHIP_CLEANUP_RULES):
+    """compile_ship_files, timing each file when profiling a serial run."""
+    if profiler is NO_PROFILER or jobs > 1:
+        with profiler.phase(f"compile {len(ship_files)} ship file(s), {jobs} job(s)"):
+            return compile_ship_files(ship_files, jobs, cache, rules)
+    templates = []
     for ship_file in ship_files:
-        layers = create_layers_for_ship(ship_file)
-        ship_summary[os.path.basename(ship_file)] = len(layers)
-        for layer in layers:
-            update_ids(layer, next_id, inside_network=False)
-            # Remove the entire workqueue node.
-            remove_workqueue(layer)
-            clear_crew_attributes(layer)
-            # Remove all "Entities" attributes from all sub-nodes of any Habitation node.
-            remove_entities_from_habitation(layer)
-            faction = ""
-            for k, v in layer.attributes:
-                if k.lower() == "type":
-                    faction = v
-                    break
+        with profiler.phase(f"parse {os.path.basename(ship_file)}"):
+            header_attrs, nodes = process_ship_file(ship_file, cache)
+            profiler.count_tree(nodes)
+        with profiler.phase(f"compile {os.path.basename(ship_file)}"):
+            templates.append(ShipTemplate(header_attrs, nodes, rules))
+    return templates
+
+def place_fleet(fleet, formation="line", footprints=None):
+    """
+    Return the (name, position) of every copy of each fleet entry, as one
+    list per entry, and the numbers of friendly and hostile ships. fleet
+    entries end in (copies, ship_name, strategy, faction); footprints gives
+    the (depth, width) of each entry's ship for the grid and wedge
+    formations.
+    """
+    # Initialize independent counters for Offset.y.
+    friendly_count = 0
+    hostile_count = 0
+    placements = []
+    for *_, copies, ship_name, strategy, faction in fleet:
+        entry = []
+        for i in range(1, copies + 1):
+            name = f"{ship_name}-{i}" if copies > 1 else ship_name
             if faction == "FriendlyShip":
-                layer.attributes = set_attr(layer.attributes, "Offset.x", "0")
-                layer.attributes = set_attr(layer.attributes, "Rotation", "0")
-                offset_y = calc_offset(friendly_count)
-                layer.attributes = set_attr(layer.attributes, "Offset.y", str(offset_y))
+                position = ("0", "0", str(calc_offset(friendly_count)))
                 friendly_count += 1
-            elif faction == "HostileShip":
-                layer.attributes = set_attr(layer.attributes, "Offset.x", "2000")
-                layer.attributes = set_attr(layer.attributes, "Rotation", "180")
-                offset_y = calc_offset(hostile_count)
-                layer.attributes = set_attr(layer.attributes, "Offset.y", str(offset_y))
+            else:
+                position = ("2000", "180", str(calc_offset(hostile_count)))
                 hostile_count += 1
-            update_shipai_layer_attribute(layer)
-            main_nodes.append(layer)
-            
-            # For each appended ship, create or update the top-level "LayerOrders" node.
-            new_id = None
-            for key, value in layer.attributes:
-                if key.lower() == "id":
-                    new_id = value
-                    break
-            if new_id is not None:
-                found = False
-                for node in main_nodes:
-                    if node.tag and node.tag.lower() == "layerorders":
-                        for attr in node.attributes:
-                            if attr[0].lower() == "id" and attr[1] == new_id:
-                                node.attributes = set_attr(node.attributes, "Scope", "Layer")
-                                node.attributes = set_attr(node.attributes, "Salvage", "false")
-                                node.attributes = set_attr(node.attributes, "Gather", "false")
-                                node.attributes = set_attr(node.attributes, "Mining", "false")
-                                node.attributes = set_attr(node.attributes, "ExteriorWork", "false")
-                                node.attributes = set_attr(node.attributes, "Id", new_id)
-                                found = True
-                                break
-                    if found:
-                        break
-                if not found:
-                    new_order = Node("LayerOrders")
-                    new_order.attributes = []
-                    new_order.attributes = set_attr(new_order.attributes, "Scope", "Layer")
-                    new_order.attributes = set_attr(new_order.attributes, "Salvage", "false")
-                    new_order.attributes = set_attr(new_order.attributes, "Gather", "false")
-                    new_order.attributes = set_attr(new_order.attributes, "Mining", "false")
-                    new_order.attributes = set_attr(new_order.attributes, "ExteriorWork", "false")
-                    new_order.attributes = set_attr(new_order.attributes, "Id", new_id)
-                    main_nodes.append(new_order)
+            entry.append((name, position))
+        placements.append(entry)
     
+    if formation != "line":
+        # Friendly ranks go back from x = 0, hostile ones from x = 2000.
+        for faction, front_x, direction in (("FriendlyShip", 0, -1), ("HostileShip", 2000, 1)):
+            ships = [(entry, copy) for entry, (*_, faction_n) in enumerate(fleet) if faction_n == faction
+                     for copy in range(len(placements[entry]))]
+            coordinates = layout_formation([footprints[entry] for entry, _ in ships], formation, front_x, direction)
+            for (entry, copy), (x, y) in zip(ships, coordinates):
+                name, (_, rotation, _) = placements[entry][copy]
+                placements[entry][copy] = (name, (str(x), rotation, str(y)))
+    return placements, friendly_count, hostile_count
+
+def check_factions(friendly_count, hostile_count):
     # Validate that at least one friendly and one hostile ship exist.
     if friendly_count < 1 or hostile_count < 1:
         sys.stderr.write("Error: At least one friendly and one hostile ship are required.\n")
         sys.exit(1)
+
+def add_layer(doc, layer):
+    doc.append(layer)
+    # For each appended ship, create or update the top-level "LayerOrders" node.
+    new_id = layer.get_attr("Id")
+    if new_id is not None:
+        upsert_layer_orders(doc, new_id)
+
+def finish_battle(doc, next_id):
+    doc.header.set_attr("NextId", str(next_id))
+    # Set top level attributes TimeIndex and PlayTime to 0.
+    doc.header.set_attr("TimeIndex", "0")
+    doc.header.set_attr("PlayTime", "0")
+    upsert_system_orders(doc)
+
+def header_next_id(doc):
+    try:
+        return int(doc.header.get_attr("NextId", 1))
+    except ValueError:
+        return 1
+
+def build_battle(doc, fleet, profiler=NO_PROFILER, formation="line"):
+    """
+    Add a fleet to doc and reset its clock. fleet is a list of
+    (template, copies, ship_name, strategy, faction) in the order the ships
+    are added, placed in one of FORMATIONS. Exits if the fleet lacks a
+    friendly or a hostile ship.
+    """
+    placements, friendly_count, hostile_count = place_fleet(fleet, formation, [template.footprint for template, *_ in fleet])
+    check_factions(friendly_count, hostile_count)
+    next_id = [header_next_id(doc)]
+    
+    # Each ship file takes the next id_count * copies Ids, in fleet order.
+    for (template, copies, ship_name, strategy, faction), entry in zip(fleet, placements):
+        with profiler.phase(f"build {copies} x {ship_name}"):
+            for name, position in entry:
+                add_layer(doc, template.instantiate(next_id, name, faction, strategy, position))
+            profiler.count("layers", copies)
+            profiler.count("nodes_copied", len(template.plan) * copies)
+            profiler.count("ids", template.id_count * copies)
     
-    main_header = set_attr(main_header, "NextId", str(next_id[0]))
+    finish_battle(doc, next_id[0])
+
+def stream_battle(doc, fleet, output_filepath, profiler=NO_PROFILER, formation="line"):
+    """
+    Like build_battle followed by write_file, but each ship copy is made,
+    written and dropped in turn, so only one copy is in memory at a time.
+    The output is the same: every copy's Ids are known before anything is
+    written, so the header's NextId and the savegame's existing LayerOrders
+    are updated first, and new LayerOrders (and SystemOrders, if the
+    savegame has none) are written after the layers they belong to.
+    """
+    placements, friendly_count, hostile_count = place_fleet(fleet, formation, [template.footprint for template, *_ in fleet])
+    check_factions(friendly_count, hostile_count)
+    base_id = header_next_id(doc)
+    
+    # The Id of each copy's layer, or None when the savegame already has its LayerOrders.
+    new_layer_orders = []
+    next_id = base_id
+    for template, copies, *_ in fleet:
+        for _ in range(copies):
+            layer_id = str(next_id + template.layer_slot) if template.layer_slot is not None else None
+            if layer_id is not None and doc.find_by_id("LayerOrders", layer_id) is not None:
+                upsert_layer_orders(doc, layer_id)
+                layer_id = None
+            new_layer_orders.append(layer_id)
+            next_id += template.id_count
+    
+    doc.header.set_attr("NextId", str(next_id))
     # Set top level attributes TimeIndex and PlayTime to 0.
-    main_header = set_attr(main_header, "TimeIndex", "0")
-    main_header = set_attr(main_header, "PlayTime", "0")
+    doc.header.set_attr("TimeIndex", "0")
+    doc.header.set_attr("PlayTime", "0")
+    has_system_orders = doc.find("SystemOrders") is not None
+    if has_system_orders:
+        upsert_system_orders(doc)
     
-    # Create or update the top-level "SystemOrders" node.
-    system_found = False
-    for node in main_nodes:
-        if node.tag and node.tag.lower() == "systemorders":
-            node.attributes = set_attr(node.attributes, "Id", "1")
-            node.attributes = set_attr(node.attributes, "Scope", "System")
-            node.attributes = set_attr(node.attributes, "FleetLogistics", "false")
-            node.attributes = set_attr(node.attributes, "BattleStations", "true")
-            system_found = True
-            break
-    if not system_found:
-        system_node = Node("SystemOrders")
-        system_node.attributes = []
-        system_node.attributes = set_attr(system_node.attributes, "Id", "1")
-        system_node.attributes = set_attr(system_node.attributes, "Scope", "System")
-        system_node.attributes = set_attr(system_node.attributes, "FleetLogistics", "false")
-        system_node.attributes = set_attr(system_node.attributes, "BattleStations", "true")
-        main_nodes.append(system_node)
+    with open(output_filepath, "w") as f:
+        f.write("\n")
+        write_header_attrs(doc.header.attributes, f)
+        rendered = {}
+        once = set()
+        for node in doc.nodes:
+            write_node(node, f, rendered)
+            once = forget_unshared(rendered, once)
+        
+        next_id = [base_id]
+        layer_orders = iter(new_layer_orders)
+        for (template, copies, ship_name, strategy, faction), entry in zip(fleet, placements):
+            with profiler.phase(f"stream {copies} x {ship_name}"):
+                # Only subtrees the template keeps alive may be cached while copies come and go.
+                shared = {id(child): None for child in template.shared_children()}
+                for name, position in entry:
+                    write_node(template.instantiate(next_id, name, faction, strategy, position), f, shared, learn=False)
+                    layer_id = next(layer_orders)
+                    if layer_id is not None:
+                        write_node(Node("LayerOrders", LAYER_ORDERS_ATTRS + [("Id", layer_id)]), f)
+                profiler.count("layers", copies)
+                profiler.count("ids", template.id_count * copies)
+        if not has_system_orders:
+            write_node(Node("SystemOrders", list(SYSTEM_ORDERS_ATTRS)), f)
+
+# Layout version of the --incremental build state.
+BUILD_STATE_VERSION = 3
+
+def file_sha256(filepath):
+    with open(filepath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class BuildState:
+    """
+    The --incremental build state of an output file, kept in the folder
+    <output>.build next to it: manifest.json records the savegame and each
+    ship file with its hash, Id range and placement, and each ship file's
+    layers are stored, as the text they are written as, in a marshal file.
+    """
+    def __init__(self, output_filepath):
+        self.directory = output_filepath + ".build"
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+    
+    def load(self, key):
+        """Return the ship entries of the last build by file name, or {} if it was made from other inputs."""
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("key") != key:
+                return {}
+            return {entry["file"]: entry for entry in manifest["ships"]}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return {}
+    
+    def load_block(self, entry):
+        """Return the layer texts stored for a manifest entry, or None."""
+        try:
+            with open(os.path.join(self.directory, entry["block"]), "rb") as f:
+                texts = marshal.loads(f.read())
+        except (OSError, KeyError, EOFError, ValueError, TypeError):
+            return None
+        return texts if isinstance(texts, list) and len(texts) == entry["copies"] else None
+    
+    def save_block(self, key, entry, texts):
+        """
+        Store the layer texts of a manifest entry and return the block's file
+        name. The name is a hash of the build key and the entry, so a block
+        is never overwritten with other layers while a manifest lists it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        name = hashlib.sha256(json.dumps([key, entry], sort_keys=True).encode("utf-8")).hexdigest()[:32] + ".marshal"
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(marshal.dumps(texts))
+        os.replace(path + ".tmp", path)
+        return name
+    
+    def save(self, key, entries):
+        """Write the manifest and remove blocks it no longer lists."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump({"key": key, "ships": entries}, f, indent=1)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+        blocks = {entry["block"] for entry in entries}
+        for name in os.listdir(self.directory):
+            if name.endswith(".marshal") and name not in blocks:
+                os.remove(os.path.join(self.directory, name))
+
+def build_battle_incremental(doc, ships, state, savegame_sha, jobs=1, cache=None, profiler=NO_PROFILER, formation="line",
+                             rules=SHIP_CLEANUP_RULES):
+    """
+    Like build_battle, for ships given as (ship_file, copies, ship_name,
+    strategy, faction), but reusing the layers of the last build in state
+    for every ship file whose content, settings, Id range and placement are
+    unchanged; only the other files are parsed and built. Returns the
+    number of ship files built.
+    
+    A ship file keeps its Id range from the last build while it needs the
+    same number of Ids; files that need a different number, and new files,
+    get new ranges after all kept ones. With no usable last build this
+    allocates exactly as build_battle does.
+    """
+    base_id = header_next_id(doc)
+    key = {"format": BUILD_STATE_VERSION, "version": version, "parser_version": PARSER_VERSION,
+           "savegame": savegame_sha, "next_id": base_id, "rules": rules.fingerprint}
+    previous = state.load(key)
+    
+    # Id counts and footprints of unchanged files come from the manifest; the others are compiled.
+    shas = [file_sha256(ship_file) for ship_file, *_ in ships]
+    changed = [ship_file for (ship_file, *_), sha in zip(ships, shas)
+               if previous.get(ship_file, {}).get("sha256") != sha]
+    templates = dict(zip(changed, load_ship_templates(changed, jobs, cache, profiler, rules)))
+    sizes = [(templates[ship_file].id_count if ship_file in templates else previous[ship_file]["id_count"]) * copies
+             for ship_file, copies, *_ in ships]
+    footprints = [templates[ship_file].footprint if ship_file in templates else tuple(previous[ship_file]["footprint"])
+                  for ship_file, *_ in ships]
+    placements, friendly_count, hostile_count = place_fleet(ships, formation, footprints)
+    check_factions(friendly_count, hostile_count)
+    
+    starts = []
+    next_free = base_id
+    for (ship_file, *_), size in zip(ships, sizes):
+        entry = previous.get(ship_file)
+        starts.append(entry["id_start"] if entry is not None and entry["id_size"] == size else None)
+        if starts[-1] is not None:
+            next_free = max(next_free, starts[-1] + size)
+    for n, size in enumerate(sizes):
+        if starts[n] is None:
+            starts[n] = next_free
+            next_free += size
+    
+    entries = []
+    built = 0
+    for (ship_file, copies, ship_name, strategy, faction), sha, start, size, footprint, placement in zip(
+            ships, shas, starts, sizes, footprints, placements):
+        entry = {"file": ship_file, "sha256": sha, "copies": copies, "ship_name": ship_name,
+                 "strategy": strategy, "faction": faction, "id_count": size // copies,
+                 "footprint": list(footprint), "id_start": start, "id_size": size,
+                 "placement": [[name, list(position)] for name, position in placement]}
+        old = previous.get(ship_file)
+        texts = None
+        if old is not None and all(old.get(k) == v for k, v in entry.items()):
+            texts = state.load_block(old)
+        with profiler.phase(f"{'build' if texts is None else 'reuse'} {copies} x {ship_name}"):
+            if texts is None:
+                template = templates.get(ship_file) or compile_ship_file(ship_file, cache, rules)
+                next_id = [start]
+                layers = [template.instantiate(next_id, name, faction, strategy, position)
+                          for name, position in placement]
+                # The layers stay alive while rendering: rendered is keyed by id(node).
+                rendered = {}
+                texts = ["\n".join(layer.iter_lines(rendered=rendered)) for layer in layers]
+                entry["block"] = state.save_block(key, entry, texts)
+                built += 1
+            else:
+                entry["block"] = old["block"]
+            for text in texts:
+                add_layer(doc, RawNode("Layer", text))
+            profiler.count("layers", copies)
+        entries.append(entry)
+    
+    finish_battle(doc, next_free)
+    state.save(key, entries)
+    return built
+
+# References that are null rather than pointing at a node.
+NULL_REFERENCES = {"", "-1"}
+
+# At most this many problems of each kind are listed by --verify.
+VERIFY_MAX_LISTED = 10
+
+def verify_save(header_attrs, nodes, rules=SHIP_CLEANUP_RULES):
+    """
+    Check the referential integrity of a parsed savegame in one pass over
+    its layers and return (errors, warnings), each a dict from a kind of
+    problem to its messages.
+    
+    Ids of nodes in layers must be unique across the save and below the
+    header's NextId, except the Ids of Network nodes and of WorkQueue jobs,
+    which are numbered per layer and only need to be unique in their layer.
+    Every Id reference (a key in rules.id_reference_keys) must point at a node of
+    its own layer, every NetworkId at a Network of its layer, each
+    ShipAI's Layer at its layer and each LayerOrders at a layer. A SystemId
+    that is not a star system of the Galaxy is only a warning.
+    """
+    errors = {}
+    warnings = {}
+    def report(problems, kind, message):
+        problems.setdefault(kind, []).append(message)
+    
+    owners = {}           # Id -> (layer index, layer name) of the node holding it.
+    max_id = None
+    references = []       # (layer index, key, value, node tag)
+    system_ids = set()
+    system_references = []
+    layer_orders = []
+    layer_ids = set()
+    id_reference_keys = rules.id_reference_keys
+    for index, top in enumerate(nodes):
+        top_tag = top.tag.lower() if top.tag else None
+        if top_tag == "galaxy":
+            stack = [top]
+            while stack:
+                node = stack.pop()
+                system_id = node.get_attr("Id")
+                if system_id is not None:
+                    system_ids.add(system_id)
+                stack.extend(node.children)
+        elif top_tag == "layerorders":
+            layer_orders.append(top.get_attr("Id"))
+        if top_tag != "layer":
+            continue
+        
+        layer_id = top.get_attr("Id")
+        layer_ids.add(layer_id)
+        where = f"layer '{top.get_attr('Name', layer_id)}'"
+        local_ids = {"network": set(), "job": set()}
+        network_references = []
+        stack = [(top, False)]
+        while stack:
+            node, in_queue = stack.pop()
+            tag = node.tag.lower() if node.tag else ""
+            in_queue = in_queue or tag == "workqueue"
+            scope = "network" if tag == "network" else "job" if in_queue else None
+            for k, v in node.attributes:
+                if k == "Id":
+                    if scope is not None:
+                        if v in local_ids[scope]:
+                            report(errors, f"duplicate {scope} Id", f"{scope} Id {v} is used twice in {where}")
+                        local_ids[scope].add(v)
+                    elif v in owners:
+                        report(errors, "duplicate Id", f"Id {v} of a '{node.tag}' node in {where} is also used in {owners[v][1]}")
+                    else:
+                        owners[v] = (index, where)
+                        if v.isdigit() and (max_id is None or int(v) > max_id):
+                            max_id = int(v)
+                elif k == "NetworkId":
+                    network_references.append(v)
+                elif k == "SystemId":
+                    system_references.append((v, where))
+                elif id_reference_keys[k]:
+                    references.append((index, k, v, node.tag))
+            if tag == "shipai" and node.get_attr("Layer", layer_id) != layer_id:
+                report(errors, "ShipAI layer mismatch", f"ShipAI of {where} (Id {layer_id}) has Layer {node.get_attr('Layer')}")
+            stack.extend((child, in_queue) for child in node.children)
+        for v in network_references:
+            if v not in NULL_REFERENCES and v not in local_ids["network"]:
+                report(errors, "unresolved NetworkId", f"NetworkId {v} in {where} is not a Network of that layer")
     
+    for index, k, v, tag in references:
+        if v in NULL_REFERENCES:
+            continue
+        owner = owners.get(v)
+        where = f"layer '{nodes[index].get_attr('Name', nodes[index].get_attr('Id'))}'"
+        if owner is None:
+            report(errors, "unresolved reference", f"{k} {v} of a '{tag}' node in {where} points at no node")
+        elif owner[0] != index:
+            report(errors, "cross-layer reference", f"{k} {v} of a '{tag}' node in {where} points into {owner[1]}")
+    for v, where in system_references:
+        if v not in system_ids and v not in NULL_REFERENCES:
+            report(warnings, "unknown SystemId", f"SystemId {v} in {where} is not a star system of the Galaxy")
+    for v in layer_orders:
+        if v not in layer_ids:
+            report(errors, "orphan LayerOrders", f"LayerOrders Id {v} matches no layer")
+    
+    next_id = Node(None, header_attrs).get_attr("NextId")
+    if next_id is None or not next_id.isdigit():
+        report(errors, "bad NextId", f"NextId is {next_id!r}, not a number")
+    elif max_id is not None and int(next_id) <= max_id:
+        report(errors, "bad NextId", f"NextId {next_id} is not greater than the highest Id {max_id}")
+    return errors, warnings
+
+def verify_file(filepath, rules=SHIP_CLEANUP_RULES):
+    """Verify a .space file with verify_save, print the outcome and return True if it has no errors."""
+    start = time.perf_counter()
+    try:
+        with open(filepath, "r") as f:
+            header_attrs, nodes = parse_file(f.read())
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Error: Cannot verify '{filepath}': {e}\n")
+        return False
+    errors, warnings = verify_save(header_attrs, nodes, rules)
+    for label, problems in (("ERROR", errors), ("Warning", warnings)):
+        for kind, messages in problems.items():
+            print(f"{label}: {len(messages)} {kind} problem(s) in '{filepath}':")
+            for message in messages[:VERIFY_MAX_LISTED]:
+                print(f"    {message}")
+            if len(messages) > VERIFY_MAX_LISTED:
+                print(f"    ... and {len(messages) - VERIFY_MAX_LISTED} more")
+    outcome = "FAILED" if errors else "OK"
+    print(f"Verify '{filepath}': {outcome} ({time.perf_counter() - start:.2f}s)")
+    return not errors
+
+def find_space_files():
+    # Locate .space files, ignoring those ending with "-start" or "-end".
+    space_files = glob.glob("*.space")
+    space_files = [f for f in space_files if not (f.endswith("-start.space") or f.endswith("-end.space"))]
+    if not space_files:
+        sys.stderr.write("Error: No valid savegame .space file found.\n")
+        sys.exit(1)
+    return space_files
+
+def find_space_file():
+    return find_space_files()[0]
+
+def load_manifest(manifest_filepath):
+    """
+    Read a batch manifest and return (savegame, scenarios), where savegame is
+    the path of the base .space file (picked as in a normal run if the
+    manifest names none) and scenarios is a list of (name, output_path,
+    ships, formation), with ships a list of (ship_file, copies, ship_name,
+    strategy, faction) and formation None unless the scenario sets one.
+    Relative paths are taken from the manifest's folder. Exits on invalid
+    manifests.
+
+    The manifest is JSON:
+
+        {"savegame": "savegame.space",
+         "scenarios": [
+            {"name": "snipers",
+             "ships": [{"file": "Frigate.ship", "count": 4, "strategy": "LongRangeSniper", "faction": "FriendlyShip"},
+                       {"file": "Raider.ship", "count": 6, "strategy": "CloseRangeAggressive", "faction": "HostileShip", "name": "Pirate"}]}]}
+
+    A ship's name defaults to the <ship-name> part of a file named like
+    <count>.<ship-name>.<strategy>.<faction>.ship, or the file's name
+    without extension. A scenario's output defaults to
+    <savegame>-<scenario-name>-start.space, and its formation to the one
+    given with --formation. An output may not be the savegame, and a .space
+    output must end in "-start.space".
+    """
+    def fail(message):
+        sys.stderr.write(f"Error: {message} in manifest '{manifest_filepath}'\n")
+        sys.exit(1)
+    
+    try:
+        with open(manifest_filepath, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Error: Cannot read manifest '{manifest_filepath}': {e}\n")
+        sys.exit(1)
+    folder = os.path.dirname(manifest_filepath)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("scenarios"), list) or not manifest["scenarios"]:
+        fail("'scenarios' must be a non-empty list")
+    savegame = manifest.get("savegame")
+    if savegame is None:
+        savegame = find_space_file()
+    elif not isinstance(savegame, str):
+        fail("'savegame' must be a file name")
+    else:
+        savegame = os.path.join(folder, savegame)
+    base, ext = os.path.splitext(savegame)
+    
+    scenarios = []
+    names = set()
+    outputs = set()
+    for n, scenario in enumerate(manifest["scenarios"], 1):
+        if not isinstance(scenario, dict):
+            fail(f"scenario {n} is not an object")
+        name = scenario.get("name")
+        if not isinstance(name, str) or not re.match(r'^[A-Za-z0-9 _\-]+$', name):
+            fail(f"scenario {n} needs a 'name' of letters, digits, spaces, '-' and '_'")
+        if name in names:
+            fail(f"scenario name '{name}' is used twice")
+        names.add(name)
+        ships = scenario.get("ships")
+        if not isinstance(ships, list) or not ships:
+            fail(f"'ships' of scenario '{name}' must be a non-empty list")
+        fleet = []
+        for ship in ships:
+            if not isinstance(ship, dict) or not isinstance(ship.get("file"), str):
+                fail(f"every ship of scenario '{name}' needs a 'file'")
+            ship_file = ship["file"]
+            source = f"scenario '{name}' ship '{ship_file}' of manifest '{manifest_filepath}'"
+            copies = ship.get("count", 1)
+            if not isinstance(copies, int) or isinstance(copies, bool):
+                sys.stderr.write(f"Error: <count> in {source} must be an integer\n")
+                sys.exit(1)
+            m = SHIP_FILENAME_RE.match(os.path.splitext(os.path.basename(ship_file))[0])
+            ship_name = ship.get("name", m.group(2) if m else os.path.splitext(os.path.basename(ship_file))[0])
+            strategy = ship.get("strategy")
+            faction = ship.get("faction")
+            if not all(isinstance(v, str) for v in (ship_name, strategy, faction)):
+                fail(f"ship '{ship_file}' of scenario '{name}' needs a 'strategy' and 'faction'")
+            check_ship_spec(source, copies, ship_name, strategy, faction)
+            fleet.append((os.path.join(folder, ship_file), copies, ship_name, strategy, faction))
+        if not any(faction == "FriendlyShip" for *_, faction in fleet) or not any(faction == "HostileShip" for *_, faction in fleet):
+            fail(f"scenario '{name}' needs at least one friendly and one hostile ship")
+        output = scenario.get("output")
+        if output is None:
+            output = f"{base}-{name}-start{ext}"
+        elif not isinstance(output, str):
+            fail(f"'output' of scenario '{name}' must be a file name")
+        else:
+            output = os.path.join(folder, output)
+        # An output must never replace the savegame or look like one to the next run.
+        if os.path.normcase(os.path.abspath(output)) == os.path.normcase(os.path.abspath(savegame)):
+            fail(f"'output' of scenario '{name}' is the savegame itself")
+        if output.lower().endswith(".space") and not output.lower().endswith("-start.space"):
+            fail(f"'output' of scenario '{name}' must end in \"-start.space\", or it would be taken for a savegame")
+        if os.path.normcase(os.path.abspath(output)) in outputs:
+            fail(f"scenario '{name}' writes the same output file as an earlier scenario")
+        outputs.add(os.path.normcase(os.path.abspath(output)))
+        formation = scenario.get("formation")
+        if formation is not None and formation not in FORMATIONS:
+            fail(f"'formation' of scenario '{name}' must be one of {', '.join(FORMATIONS)}")
+        scenarios.append((name, output, fleet, formation))
+    return savegame, scenarios
+
+def run_single(args, cache, profiler=NO_PROFILER, warm=None, rules=SHIP_CLEANUP_RULES):
+    """
+    Add the ships of the *.ship files in the current folder to its savegame,
+    cleaned up with rules, and return the output path. With a WatchState as
+    warm, files it already holds are not parsed again.
+    """
+    load_document, load_templates = (warm.document, warm.ship_templates) if warm else (load_base_document, load_ship_templates)
+    main_space_file = find_space_file()
+    doc = load_document(main_space_file, cache, args.lazy, profiler)
+    
+    ship_files = glob.glob("*.ship")
+    if not ship_files:
+        sys.stderr.write("Error: No .ship files found in the folder.\n")
+        sys.exit(1)
+    ship_specs = [parse_ship_filename(ship_file) for ship_file in ship_files]
     base, ext = os.path.splitext(main_space_file)
     output_filepath = f"{base}-start{ext}"
-    write_file(main_header, main_nodes, output_filepath)
+    if args.incremental:
+        built = build_battle_incremental(doc, [(ship_file, *spec) for ship_file, spec in zip(ship_files, ship_specs)],
+                                         BuildState(output_filepath), file_sha256(main_space_file),
+                                         args.jobs, cache, profiler, args.formation, rules)
+        print(f"Incremental build: rebuilt {built} of {len(ship_files)} ship file(s).")
+    elif args.stream:
+        templates = load_templates(ship_files, args.jobs, cache, profiler, rules)
+        stream_battle(doc, [(template, *spec) for template, spec in zip(templates, ship_specs)],
+                      output_filepath, profiler, args.formation)
+    else:
+        templates = load_templates(ship_files, args.jobs, cache, profiler, rules)
+        build_battle(doc, [(template, *spec) for template, spec in zip(templates, ship_specs)], profiler, args.formation)
+    
+    if not args.stream:
+        with profiler.phase(f"write {os.path.basename(output_filepath)}"):
+            write_file(doc.header.attributes, doc.nodes, output_filepath)
+            profiler.count("bytes", os.path.getsize(output_filepath))
     
     print("SUCCESS: Processed", len(ship_files), "ship file(s):")
-    for ship_file, count in ship_summary.items():
-        print(f"    {ship_file}: {count}")
+    for ship_file, (copies, *_) in zip(ship_files, ship_specs):
+        print(f"    {os.path.basename(ship_file)}: {copies}")
     print(f"Output file: '{output_filepath}'")
+    return output_filepath
+
+def run_batch(args, cache, profiler=NO_PROFILER, warm=None, rules=SHIP_CLEANUP_RULES):
+    """
+    Write one output savegame per scenario of the --manifest file and return
+    their paths. With a WatchState as warm, files it already holds are not
+    parsed again and scenarios whose inputs are unchanged are skipped.
+    """
+    load_document, load_templates = (warm.document, warm.ship_templates) if warm else (load_base_document, load_ship_templates)
+    savegame, scenarios = load_manifest(args.manifest)
+    
+    # Parse the savegame and every distinct ship file once; all scenarios share them.
+    start = time.perf_counter()
+    base_doc = load_document(savegame, cache, args.lazy, profiler)
+    ship_files = list(dict.fromkeys(ship_file for _, _, fleet, _ in scenarios for ship_file, *_ in fleet))
+    for ship_file in ship_files:
+        if not os.path.isfile(ship_file):
+            sys.stderr.write(f"Error: Ship file '{ship_file}' listed in manifest '{args.manifest}' not found.\n")
+            sys.exit(1)
+    templates = dict(zip(ship_files, load_templates(ship_files, args.jobs, cache, profiler, rules)))
+    print(f"Parsed '{savegame}' and {len(ship_files)} ship file(s) in {time.perf_counter() - start:.2f}s")
+    
+    for name, output_filepath, fleet, formation in scenarios:
+        if warm is not None:
+            signature = warm.signature(savegame, fleet, formation or args.formation)
+            if warm.is_fresh(output_filepath, signature):
+                print(f"    {name}: unchanged")
+                continue
+        start = time.perf_counter()
+        doc = base_doc.copy()
+        scenario_fleet = [(templates[ship_file], copies, ship_name, strategy, faction)
+                          for ship_file, copies, ship_name, strategy, faction in fleet]
+        if args.stream:
+            stream_battle(doc, scenario_fleet, output_filepath, profiler, formation or args.formation)
+        else:
+            build_battle(doc, scenario_fleet, profiler, formation or args.formation)
+            with profiler.phase(f"write {os.path.basename(output_filepath)}"):
+                write_file(doc.header.attributes, doc.nodes, output_filepath)
+                profiler.count("bytes", os.path.getsize(output_filepath))
+        if warm is not None:
+            warm.record(output_filepath, signature)
+        ship_count = sum(copies for _, copies, *_ in fleet)
+        print(f"    {name}: {ship_count} ship(s) -> '{output_filepath}' in {time.perf_counter() - start:.2f}s")
+    print("SUCCESS: Generated", len(scenarios), "scenario(s).")
+    return [output_filepath for _, output_filepath, _, _ in scenarios]
+
+# The fleet --all-maps worker processes build, set once per worker by init_map_worker.
+_map_fleet = None
+
+def init_map_worker(fleet):
+    global _map_fleet
+    _map_fleet = fleet
+
+def generate_map(space_filepath, fleet=None, cache=None, lazy=False, stream=False, formation="line", profiler=NO_PROFILER,
+                 load_document=load_base_document):
+    """
+    Add fleet (by default the worker's shared fleet) to one savegame, write
+    its -start output and return (output path, seconds). The new Ids start
+    from the savegame's own NextId. load_document is called like
+    load_base_document, which it defaults to.
+    """
+    start = time.perf_counter()
+    fleet = _map_fleet if fleet is None else fleet
+    doc = load_document(space_filepath, cache, lazy, profiler)
+    base, ext = os.path.splitext(space_filepath)
+    output_filepath = f"{base}-start{ext}"
+    if stream:
+        stream_battle(doc, fleet, output_filepath, profiler, formation)
+    else:
+        build_battle(doc, fleet, profiler, formation)
+        with profiler.phase(f"write {os.path.basename(output_filepath)}"):
+            write_file(doc.header.attributes, doc.nodes, output_filepath)
+            profiler.count("bytes", os.path.getsize(output_filepath))
+    return output_filepath, time.perf_counter() - start
+
+def run_all_maps(args, cache, profiler=NO_PROFILER, warm=None, rules=SHIP_CLEANUP_RULES):
+    """
+    Add the ships of the *.ship files in the current folder to every
+    savegame in it, args.jobs maps at a time, and return the output paths.
+    The ship files are compiled once and shared by all maps. With a
+    WatchState as warm, maps generated one at a time stay parsed in it.
+    """
+    load_document, load_templates = (warm.document, warm.ship_templates) if warm else (load_base_document, load_ship_templates)
+    space_files = sorted(find_space_files())
+    ship_files = glob.glob("*.ship")
+    if not ship_files:
+        sys.stderr.write("Error: No .ship files found in the folder.\n")
+        sys.exit(1)
+    ship_specs = [parse_ship_filename(ship_file) for ship_file in ship_files]
+    
+    start = time.perf_counter()
+    templates = load_templates(ship_files, args.jobs, cache, profiler, rules)
+    fleet = [(template, *spec) for template, spec in zip(templates, ship_specs)]
+    print(f"Parsed {len(ship_files)} ship file(s) in {time.perf_counter() - start:.2f}s")
+    
+    # Each result is (output path, seconds), or None if the map failed; one bad map does not stop the others.
+    results = []
+    def collect(space_file, get_result):
+        try:
+            results.append(get_result())
+        except SystemExit:
+            results.append(None)
+        except (ValueError, OSError) as e:
+            sys.stderr.write(f"Error: Cannot process '{space_file}': {e}\n")
+            results.append(None)
+    
+    jobs = min(args.jobs, len(space_files))
+    with profiler.phase(f"generate {len(space_files)} map(s), {jobs} job(s)"):
+        if jobs <= 1:
+            for space_file in space_files:
+                collect(space_file, lambda: generate_map(space_file, fleet, cache, args.lazy, args.stream, args.formation, profiler,
+                                                         load_document))
+        else:
+            # The fleet is sent to each worker once, not with every map. Workers parse
+            # their maps themselves (through the parse cache), so warm does not hold them.
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_map_worker, initargs=(fleet,)) as pool:
+                futures = [pool.submit(generate_map, space_file, None, cache, args.lazy, args.stream, args.formation)
+                           for space_file in space_files]
+                for space_file, future in zip(space_files, futures):
+                    collect(space_file, future.result)
+    
+    ship_count = sum(copies for copies, *_ in ship_specs)
+    for space_file, result in zip(space_files, results):
+        if result is None:
+            print(f"    {space_file}: FAILED")
+        else:
+            print(f"    {space_file}: {ship_count} ship(s) -> '{result[0]}' in {result[1]:.2f}s")
+    failed = results.count(None)
+    if failed:
+        sys.stderr.write(f"Error: {failed} of {len(space_files)} map(s) failed.\n")
+        sys.exit(1)
+    print(f"SUCCESS: Generated {len(space_files)} map(s) with {len(ship_files)} ship file(s) "
+          f"in {time.perf_counter() - start:.2f}s, {jobs} job(s)")
+    return [output_filepath for output_filepath, _ in results]
+
+def file_stamp(filepath):
+    """Return (modification time, size) of a file, or None if it does not exist."""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+class WatchState:
+    """
+    What --watch keeps in memory between regenerations: the prepared
+    savegame and the compiled ship templates, each reused while its file's
+    modification time and size are unchanged, and the inputs each batch
+    output was last generated from.
+    """
+    def __init__(self):
+        self.documents = {}  # Path -> (stamp, SaveDocument).
+        self.requested = set()  # Paths of the savegames asked for since the last prune().
+        self.templates = {}  # Path -> (stamp, ShipTemplate).
+        self.outputs = {}    # Output path -> (signature, stamp of the written file).
+        self.rules_fingerprint = SHIP_CLEANUP_RULES.fingerprint
+    
+    def document(self, space_filepath, cache=None, lazy=False, profiler=NO_PROFILER):
+        """load_base_document, parsing only when the file changed; returns a copy to build on."""
+        stamp = file_stamp(space_filepath)
+        entry = self.documents.get(space_filepath)
+        if entry is None or entry[0] != stamp:
+            entry = self.documents[space_filepath] = (stamp, load_base_document(space_filepath, cache, lazy, profiler))
+        self.requested.add(space_filepath)
+        return entry[1].copy()
+    
+    def prune(self):
+        """Drop the savegames not asked for since the last prune, such as removed maps."""
+        self.documents = {path: entry for path, entry in self.documents.items() if path in self.requested}
+        self.requested = set()
+    
+    def ship_templates(self, ship_files, jobs=1, cache=None, profiler=NO_PROFILER, rules=SHIP_CLEANUP_RULES):
+        """load_ship_templates, compiling only new and changed files, or every file when the rules changed."""
+        if rules.fingerprint != self.rules_fingerprint:
+            self.templates = {}
+            self.rules_fingerprint = rules.fingerprint
+        stamps = {ship_file: file_stamp(ship_file) for ship_file in ship_files}
+        stale = [ship_file for ship_file in ship_files if self.templates.get(ship_file, (None,))[0] != stamps[ship_file]]
+        compiled = dict(zip(stale, load_ship_templates(stale, jobs, cache, profiler, rules)))
+        # Templates of removed ship files are dropped.
+        self.templates = {ship_file: (stamps[ship_file], compiled[ship_file]) if ship_file in compiled else self.templates[ship_file]
+                          for ship_file in ship_files}
+        return [self.templates[ship_file][1] for ship_file in ship_files]
+    
+    def signature(self, space_filepath, fleet, formation):
+        """Return what a batch output depends on: the input stamps, the rules, the fleet and the formation."""
+        return (self.documents[space_filepath][0], self.rules_fingerprint, formation,
+                tuple((self.templates[ship_file][0], *spec) for ship_file, *spec in fleet))
+    
+    def is_fresh(self, output_filepath, signature):
+        """Whether output_filepath was generated from signature and has not changed since."""
+        entry = self.outputs.get(output_filepath)
+        return entry is not None and entry == (signature, file_stamp(output_filepath))
+    
+    def record(self, output_filepath, signature):
+        self.outputs[output_filepath] = (signature, file_stamp(output_filepath))
+    
+    def watched_files(self, args):
+        """Return the input files to poll: the folder's .ship and savegame files, the manifest and every file loaded."""
+        files = glob.glob("*.ship") + [f for f in glob.glob("*.space") if not (f.endswith("-start.space") or f.endswith("-end.space"))]
+        files += [f for f in (args.manifest, args.rules) if f]
+        files += list(self.documents) + list(self.templates)
+        return {os.path.normpath(f) for f in files}
+
+def generate(args, cache, warm=None, rules=SHIP_CLEANUP_RULES):
+    """Write the output savegame(s), profiling them if asked, and return their paths."""
+    profiler = Profiler() if args.profile else NO_PROFILER
+    try:
+        if args.manifest:
+            outputs = run_batch(args, cache, profiler, warm, rules)
+        elif args.all_maps:
+            outputs = run_all_maps(args, cache, profiler, warm, rules)
+        else:
+            outputs = [run_single(args, cache, profiler, warm, rules)]
+    except BaseException:
+        # Under --watch the next run starts a new profiler.
+        if args.profile:
+            tracemalloc.stop()
+        raise
+    if args.profile:
+        profiler.print_summary()
+        profiler.stop(args.profile_json)
+    return outputs
+
+def watch(args, cache):
+    """
+    Poll the input files every args.watch seconds and regenerate when any
+    of them is changed, added or removed, until interrupted with Ctrl+C.
+    Errors are reported and the next change is awaited.
+    """
+    warm = WatchState()
+    snapshot = None
+    try:
+        while True:
+            stamps = {f: file_stamp(f) for f in warm.watched_files(args)}
+            if stamps != snapshot:
+                if snapshot is not None:
+                    changed = sorted(f for f in set(stamps) | set(snapshot) if stamps.get(f) != snapshot.get(f))
+                    print(f"Changed: {', '.join(changed)}")
+                start = time.perf_counter()
+                outputs = []
+                try:
+                    rules = load_rules(args.rules) if args.rules else SHIP_CLEANUP_RULES
+                    outputs = [os.path.normpath(f) for f in generate(args, cache, warm, rules)]
+                    warm.prune()
+                    if args.verify is not None:
+                        all([verify_file(f, rules) for f in outputs])
+                    print(f"Regenerated in {time.perf_counter() - start:.2f}s")
+                except (SystemExit, ValueError, OSError) as e:
+                    # A file saved halfway, or briefly missing during an editor's save, must not end the watch.
+                    if not isinstance(e, SystemExit):
+                        sys.stderr.write(f"Error: {e}\n")
+                    print(f"Generation failed after {time.perf_counter() - start:.2f}s")
+                # Files first loaded in this run, and the outputs just written, are stamped now.
+                snapshot = {f: stamps[f] if f in stamps and f not in outputs else file_stamp(f)
+                            for f in warm.watched_files(args)}
+                print(f"Watching for changes every {args.watch:g}s (Ctrl+C to stop)...")
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Add the ships in the *.ship files of the current folder to the savegame .space file.")
+    parser.add_argument("--manifest", metavar="FILE",
+                        help="generate every scenario of a JSON batch manifest instead of using the *.ship filenames")
+    parser.add_argument("--all-maps", action="store_true",
+                        help="add the ships to every savegame .space file in the folder, not just the first; "
+                             "with --jobs N, N maps are generated at once")
+    parser.add_argument("--formation", choices=FORMATIONS, default="line",
+                        help="how each faction's ships are placed: one line 100 apart (default), "
+                             "or a grid or wedge spaced by each ship's size")
+    parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                        help="parse and compile ship files in N processes (default: 1)")
+    parser.add_argument("--lazy", action="store_true",
+                        help="copy the savegame's untouched top-level nodes to the output verbatim instead of parsing and rewriting them")
+    parser.add_argument("--stream", action="store_true",
+                        help="write each ship copy as soon as it is made, so memory use does not grow with the fleet size")
+    parser.add_argument("--incremental", action="store_true",
+                        help="reuse the layers of unchanged ship files from the last --incremental run (kept in <output>.build)")
+    parser.add_argument("--watch", type=float, nargs="?", const=1.0, metavar="SECONDS",
+                        help="stay running, keep parsed files in memory and regenerate whenever an input file changes, "
+                             "polling every SECONDS (default: 1)")
+    parser.add_argument("--rules", metavar="FILE",
+                        help="JSON file of extra ship cleanup rules and Id reference keys, added to the built-in ones")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always parse the input files, without reading or writing the parse cache")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, metavar="DIR",
+                        help=f"parse cache directory (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_MAX_BYTES // (1024 * 1024), metavar="MB",
+                        help="evict least recently used parse cache entries above this size (default: %(default)s)")
+    parser.add_argument("--verify", nargs="*", metavar="FILE",
+                        help="check Ids and Id references of the output after writing it; "
+                             "given files, only check those .space files and exit")
+    parser.add_argument("--profile", action="store_true",
+                        help="print the time, peak traced memory and node counts of each phase")
+    parser.add_argument("--profile-json", metavar="FILE",
+                        help="with --profile, also write the profile to FILE as JSON")
+    args = parser.parse_args(argv)
+    if args.profile_json:
+        args.profile = True
+    if args.incremental and args.manifest:
+        parser.error("--incremental cannot be used with --manifest")
+    if args.all_maps and (args.manifest or args.incremental):
+        parser.error("--all-maps cannot be used with --manifest or --incremental")
+    if args.incremental and args.stream:
+        parser.error("--incremental cannot be used with --stream")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.watch is not None and args.watch <= 0:
+        parser.error("--watch interval must be above 0")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    cache = None if args.no_cache else ParseCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    
+    # Print startup header.
+    print(f"TLS v: PC - ALPHA13D - STEAM, Script v: {version} by Zenrath")
+    
+    rules = load_rules(args.rules) if args.rules else SHIP_CLEANUP_RULES
+    if args.verify:
+        sys.exit(0 if all([verify_file(f, rules) for f in args.verify]) else 1)
+    
+    if args.watch is not None:
+        watch(args, cache)
+        return
+    outputs = generate(args, cache, rules=rules)
+    if args.verify is not None and not all([verify_file(f, rules) for f in outputs]):
+        sys.exit(1)
     
 if __name__ == "__main__":
     main()